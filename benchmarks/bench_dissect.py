@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of the Artemis package dissector.
+Compares artemis_connector.dissect and its heartbeat fast path
+with the dict based decoder it replaced (legacy_dissect below).
+	call: python benchmarks/bench_dissect.py [--number N]
+"""
+
+import argparse
+import os
+import struct
+import sys
+import timeit
+from warnings import warn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core import artemis_connector
+from core.artemis_connector import PACKAGE_TYPES, PACKAGE_SUBTYPES
+
+def sample_datagrams():
+	"""returns one datagram of each type an Artemis client sends"""
+	name = b"Artemis"
+	def sector(subtype, body):
+		body = struct.pack(">H", subtype) + body + struct.pack("<H", len(name)) + name
+		return struct.pack(">HHHHH", 0x9000, 1234, 0x8600, 7, len(body)) + body
+	return {
+		"Client-hello":	struct.pack(">HHHH", 0x8000, 1234, 0x82ff, 1) + struct.pack(">HHH", 0, 0xffff, 0)
+						+ struct.pack(">17H", *range(1, 18)) + bytes(2),
+		"Client-bye":	struct.pack(">HHHH", 0x9000, 1234, 0x84ff, 3) + bytes(2),
+		"Heartbeat":	struct.pack(">HHHH", 0x9000, 1234, 0x85ff, 42),
+		"?+Heartbeat":	struct.pack(">HHHH", 0x9000, 1234, 0x8aff, 42) + struct.pack(">HHHH", 1, 2, 3, 4),
+		"Heartbeat-Ack":	struct.pack(">HHHHHH", 0x9000, 1234, 0x01ff, 42, 42, 999),
+		"Sector-Enter":	sector(0x0400, bytes([3, 4])),
+		"Sector-Leave":	sector(0x0800, struct.pack("<HH", 4711, 0)),
+		"Sector-Kill":	sector(0x0c00, struct.pack("<HHI", 4711, 0, 5)),
+	}
+
+#the decoder of artemis_connector before it was rewritten with memoryview and precompiled structs
+def legacy_dissect(data):
+	"""
+	Dissects an Artemis package.
+	Returns a list of dicts, containing meaningful information of that package.
+	Raises an exception if a packet could not be dissected.
+	"""
+	#We do no error checking here, since we use exceptions
+	preamble = dict()
+	flags = int.from_bytes(data[0:2], byteorder="big")
+	preamble["flags"] = flags
+	preamble["flags_time"] = flags_time = flags & 0x8000
+	preamble["flags_connection_number"] = flags & 0x7000
+	preamble["flags_unknown"] = flags & 0xfff
+	if flags_time != 0:
+		preamble["preamble_time"] = int.from_bytes(data[2:4], byteorder="big")
+		data = data[4:]
+	else:
+		data = data[2:]
+	retlist = []
+	#from now on data begins here
+	while data:	# while len(data) > 0
+		package = dict()
+		subtype = PACKAGE_TYPES[int.from_bytes(data[:2], byteorder="big")]	#raises KeyError
+		package["type"] = subtype
+		if subtype == "Data":
+			if int.from_bytes(data[2:4]) != 0:
+				raise ValueError
+			package["Number"] = int.from_bytes(data[4:6], byteorder="big")
+			data = data[6:]
+		else:
+			package["Number"] = int.from_bytes(data[2:4], byteorder="big")
+			data = data[4:]
+
+		#from now on data begins here
+		if subtype == "Client-hello":
+
+#			package["payload"] = list(map(lambda t: t[0], struct.iter_unpack("<H", data)))
+#			print(package["payload"])
+
+			if int.from_bytes(data[0:2], byteorder="big") != 0:
+				raise ValueError
+			if int.from_bytes(data[2:4], byteorder="big") != 0xFFFF:
+				package["connection_number"] = int.from_bytes(data[2:4], byteorder="big")
+			if int.from_bytes(data[4:6], byteorder="big") != 0:
+				raise ValueError
+
+			package["payload-1-echo"] = list(map(lambda t: t[0], struct.iter_unpack(">H", data[6:18])))
+			package["payload-2"] = list(map(lambda t: t[0], struct.iter_unpack(">H", data[18:26])))
+			package["payload-3-echo"] = list(map(lambda t: t[0], struct.iter_unpack(">H", data[26:40])))
+			if int.from_bytes(data[40:], byteorder="big") != 0:
+				raise ValueError
+			#Dont know what all this means yet.
+			#print("PREAMBLE: {flags_time: " + str(hex(preamble["flags_time"])) +", flags_connection_number" + str(hex(preamble["flags_connection_number"])) + ", flags_unknown:" + str(hex(preamble["flags_unknown"])) + ", preamble_time: " + str(preamble.get("time")) +"}" )
+			#print("PACKAGE: " + str(package))
+			data = []
+		elif subtype == "Client-bye":
+			if int.from_bytes(data[0:], byteorder="big") != 0:
+				raise ValueError
+			data = []
+		elif subtype == "Error":
+			if int.from_bytes(data[0:], byteorder="big") != 0:
+				raise ValueError
+			data = []
+		elif subtype == "Heartbeat":
+			pass
+		elif subtype == "?+Heartbeat":
+			package["payload-as-uint16-list"] = list(struct.unpack(">HHHH", data[0:8]))
+			data = data[8:]
+		elif subtype == "Heartbeat-Ack":
+			if int.from_bytes(data[0:2], byteorder="big") != package["Number"]:
+				raise ValueError
+			package["acked-time"] = int.from_bytes(data[2:4], byteorder="big")
+			data = data[4:]
+		elif subtype == "Sector":
+			#length = int.from_bytes(data[0:2], byteorder="big")
+			subsubtype = PACKAGE_SUBTYPES[int.from_bytes(data[2:4], byteorder="big")]	#raises KeyError
+			package["subtype"] = subsubtype
+			data = data[4:]
+			if subsubtype == "Sector-Enter":
+				package["X"] = int(data[0])
+				package["Y"] = int(data[1])
+				data = data[2:]
+			elif subsubtype == "Sector-Leave":
+				package["ID"] = int.from_bytes(data[0:2], byteorder="little")
+				if int.from_bytes(data[2:4], byteorder="big") != 0:
+					raise ValueError
+				data = data[4:]
+			elif subsubtype == "Sector-Kill":
+				package["ID"] = int.from_bytes(data[0:2], byteorder="little")
+				if int.from_bytes(data[2:4], byteorder="big") != 0:
+					raise ValueError
+				package["Kills"] = int.from_bytes(data[4:8], byteorder="little")
+				data = data[8:]
+			else:
+				warn("WTF?")
+			strlen = int.from_bytes(data[0:2], byteorder="little")
+			#print("Ship-Name ("+str(strlen)+"): " + str(data[2:strlen+2]))
+			package["Ship-Name"] = data[2:strlen+2].decode(encoding="utf-8")
+			data = data[strlen+2:]
+		package.update(preamble)
+		retlist.append(package)
+	return retlist
+
+def bench(function, data, number):
+	"""returns nanoseconds per call"""
+	return timeit.timeit(lambda: function(data), number=number) / number * 1e9
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Compares the Artemis package dissectors.')
+	parser.add_argument('--number', '-n', type=int, default=100000, help='calls per measurement')
+	args = parser.parse_args()
+
+	print("%-14s %12s %12s %12s %8s" % ("package", "legacy ns", "dissect ns", "fast ns", "speedup"))
+	for name, data in sample_datagrams().items():
+		legacy = bench(legacy_dissect, data, args.number)
+		current = bench(artemis_connector.dissect, data, args.number)
+		if artemis_connector.dissect_heartbeat(data) is not None:
+			fast = bench(artemis_connector.dissect_heartbeat, data, args.number)
+			speedup = legacy / fast
+			fast = "%12.0f" % fast
+		else:
+			speedup = legacy / current
+			fast = "%12s" % "-"
+		print("%-14s %12.0f %12.0f %s %7.1fx" % (name, legacy, current, fast, speedup))
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks of the codec and engine hot paths.
+Measures operations per second and the memory allocated per operation (with tracemalloc) of
+dissect for each package type, the compose functions of the artemis connector,
+the engine functions Artemis clients call, proceed_turn, get_game_state_as_json and the rpc setters.
+Those that depend on the game state are measured with each state of STATES.
+The countdowns the engine starts are cancelled, autosaves go to a temporary directory.
+Prints the results as JSON.
+	call: python benchmarks/bench_hotpaths.py [--seconds S] [--states empty,typical,clients500] [--capture FILE]
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core import game_state, engine_turns, engine_artemis, artemis_connector, capture
+from core.engine_rpc import rpc
+from bench_dissect import sample_datagrams
+
+#state name -> number of tracked Artemis clients
+STATES = {
+	"empty":		0,		#a new game: no enemies, no clients
+	"typical":		8,		#the default game with a few ships, some of them in combat
+	"clients500":	500,	#the default game with many ships
+}
+BENCH_CLIENT = ("10.0.0.1", 2010)	#the client that enters sectors in the benchmarks
+BENCH_SECTOR = (3, 3)
+
+
+def build_state(name, seed):
+	"""replaces the game state with a fresh one of the given size"""
+	random.seed(seed)
+	if game_state.game._countdown:
+		game_state.game._countdown.cancel()
+	game_state.game.clear()
+	game = game_state.create_game(None)
+	if STATES[name]:
+		engine_turns.start_default_game()
+	else:
+		engine_turns.start()
+	game.turn.max_turns = 1000000	#proceed_turn must not run out of turns
+	sector = game.map[BENCH_SECTOR[0]][BENCH_SECTOR[1]]
+	sector.gm_allow = True
+	sector.enemies = max(sector.enemies, 5)
+	for i in range(STATES[name]):
+		ip = "127.1." + str(i // 250) + "." + str(i % 250 + 1)
+		client = game.artemis_clients[ip]
+		client.shipname = "Ship " + str(i)
+		client.in_combat = False
+		client.log[float(i)] = ("kills", 1)
+		if i % 4 == 0:
+			engine_artemis._start_battle(ip, game.map[i % 8][(i // 8) % 8])
+	return game
+
+def measure(function, seconds):
+	"""Returns the operations per second of function, the best of several runs"""
+	timer = timeit.Timer(function)
+	number, elapsed = timer.autorange()
+	repeat = max(1, int(seconds / max(elapsed, 1e-9)))
+	best = min(timer.repeat(repeat=min(repeat, 5), number=number))
+	return number / best
+
+def allocations(function, calls):
+	"""
+	Returns the bytes allocated at peak during one call of function
+	and the bytes still allocated after it, both averaged over calls.
+	"""
+	tracemalloc.start()
+	try:
+		function()	#caches
+		start = tracemalloc.get_traced_memory()[0]
+		peak = 0
+		for _ in range(calls):
+			tracemalloc.reset_peak()
+			before = tracemalloc.get_traced_memory()[0]
+			function()
+			peak += tracemalloc.get_traced_memory()[1] - before
+		retained = tracemalloc.get_traced_memory()[0] - start
+	finally:
+		tracemalloc.stop()
+	return peak / calls, retained / calls
+
+def codec_benchmarks(capture_path):
+	"""Returns (name, function) of the benchmarks that do not depend on the game state"""
+	benchmarks = []
+	datagrams = sample_datagrams()
+	for name, data in datagrams.items():
+		benchmarks.append(("dissect " + name, lambda data=data: artemis_connector.dissect(data)))
+	if capture_path:
+		inbound = []
+		for _, direction, _, data in capture.read_capture(capture_path):
+			if direction != capture.INBOUND:
+				continue
+			try:
+				artemis_connector.dissect(data)
+			except Exception:
+				continue	#garbage is dissected as seldom as possible
+			inbound.append(data)
+		if inbound:
+			records = itertools.cycle(inbound)
+			benchmarks.append(("dissect capture", lambda: artemis_connector.dissect(next(records))))
+	hello = artemis_connector.dissect(datagrams["Client-hello"])[0]
+	template = artemis_connector.compose_heartbeat_template(1)
+	sector = game_state.init_sector(x=3, y=3, coordinates="D4", seed=4711, name="Sector 4711")
+	battle = dict(sector, id=1234)
+	turn = {"remaining": 1200.5, "turn_number": 3, "max_turns": 10, "interlude": False}
+	benchmarks += [
+		("compose_preamble",			lambda: artemis_connector.compose_preamble(1, True, "Data", 7)),
+		("compose_heartbeat_template",	lambda: artemis_connector.compose_heartbeat_template(1)),
+		("compose_heartbeat",			lambda: artemis_connector.compose_heartbeat(template, 42)),
+		("compose_hello",				lambda: artemis_connector.compose_hello(1, hello)),
+		("compose_data",				lambda: artemis_connector.compose_data(BENCH_CLIENT, artemis_connector.TURN_OVER_PAYLOAD)),
+		("compose_map_col_header",		lambda: artemis_connector.compose_map_col_header(3)),
+		("compose_map_sector",			lambda: artemis_connector.compose_map_sector(sector)),
+		("compose_sector",				lambda: artemis_connector.compose_sector(battle)),
+		("compose_turn_status",			lambda: artemis_connector.compose_turn_status(turn)),
+		("compose_turn_over",			artemis_connector.compose_turn_over),
+		("compose_shipname",			lambda: artemis_connector.compose_shipname("Artemis")),
+	]
+	return benchmarks
+
+def state_benchmarks():
+	"""
+	Returns (name, setup) of the benchmarks that depend on the game state.
+	setup is called once the state is built and returns the function to measure,
+	so fetching what the function works on is not measured with it.
+	"""
+	x, y = BENCH_SECTOR
+	battle = dict()
+	def enter():
+		battle.update(engine_artemis.enter_sector(x, y, "Bench", BENCH_CLIENT))
+	def kill():
+		if not game_state.game.artemis_clients[BENCH_CLIENT[0]].in_combat:
+			enter()
+		engine_artemis.kills_in_sector("Bench", battle["id"], 1, BENCH_CLIENT)
+	def compose_map_col():
+		column = engine_artemis.get_map()[3]
+		return lambda: artemis_connector.compose_map_col(3, column)
+	def compose_ships():
+		ships = engine_artemis.get_ships()
+		return lambda: artemis_connector.compose_ships(ships)
+	game_rpc = rpc()
+	return [
+		("compose_map_col",		compose_map_col),
+		("compose_ships",		compose_ships),
+		("get_map",				lambda: engine_artemis.get_map),
+		("get_ships",			lambda: engine_artemis.get_ships),
+		("enter_sector",		lambda: enter),
+		("kills_in_sector",		lambda: kill),
+		("proceed_turn",		lambda: engine_turns.proceed_turn),
+		("get_game_state_as_json",	lambda: game_state.get_game_state_as_json),
+		("rpc.set",				lambda: lambda: game_rpc.set("game.map.3.3.difficulty", 5)),
+		("rpc.modify",			lambda: lambda: game_rpc.modify("game.admiral.strategy_points", 1)),
+	]
+
+def run(name, state, function, args):
+	ops = measure(function, args.seconds)
+	peak, retained = allocations(function, args.allocation_calls)
+	return {
+		"name":		name,
+		"state":	state,
+		"ops_per_second":	ops,
+		"ns_per_op":	1e9 / ops,
+		"peak_bytes_per_op":	peak,
+		"retained_bytes_per_op":	retained,
+	}
+
+def main(args):
+	results = []
+	artemis_connector.register_connection(BENCH_CLIENT, 1)	#for compose_data
+	try:
+		for name, function in codec_benchmarks(args.capture):
+			if args.filter in name:
+				results.append(run(name, None, function, args))
+		for state in args.states:
+			for name, setup in state_benchmarks():
+				if args.filter in name:
+					build_state(state, args.seed)	#each benchmark starts with the same state
+					results.append(run(name, state, setup(), args))
+	finally:
+		artemis_connector.CONNECTIONS.pop(BENCH_CLIENT, None)
+		if game_state.game._countdown:
+			game_state.game._countdown.cancel()
+	return results
+
+def parse_states(states):
+	"""Returns the list of state names of "name,name" """
+	states = states.split(",")
+	for state in states:
+		if state not in STATES:
+			raise argparse.ArgumentTypeError("unknown state " + state + ", choose from " + ", ".join(STATES))
+	return states
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Benchmarks the codec and engine hot paths.')
+	parser.add_argument('--seconds', type=float, default=1, help='measuring time per benchmark, roughly')
+	parser.add_argument('--allocation_calls', type=int, default=100, help='calls traced by tracemalloc per benchmark')
+	parser.add_argument('--states', type=parse_states, default=list(STATES), metavar='STATE,...', help='game states: ' + ", ".join(STATES))
+	parser.add_argument('--filter', type=str, default="", help='only run benchmarks whose name contains this')
+	parser.add_argument('--capture', type=str, metavar='FILE', help='also dissect the inbound datagrams of this capture file')
+	parser.add_argument('--seed', type=int, default=0, help='of the generated maps')
+	args = parser.parse_args()
+
+	cwd = os.getcwd()
+	with tempfile.TemporaryDirectory() as directory, open(os.devnull, "w") as devnull:
+		os.chdir(directory)	#autosaves of proceed_turn
+		try:
+			with contextlib.redirect_stdout(devnull):	#the engine logs every action
+				results = main(args)
+		finally:
+			os.chdir(cwd)
+	print(json.dumps({
+		"python":	platform.python_version(),
+		"platform":	platform.platform(),
+		"results":	results,
+	}, indent=2))
@@ -623,8 +623,9 @@ score_frame.set_column_headings("Name","Kills","Cleared","Entered", bg=ships_col
 score_frame.enable_right_click_menu()
 
 #techboard
-#tech_frame.show()
-tech_frame.set_column_headings("Name","Address", bg=ships_color, fg="white")
+if allow_privilege("gm"):
+	tech_frame.show()
+tech_frame.set_column_headings("Name","Address","RTT","Jitter","Loss", bg=ships_color, fg="white")
 tech_frame.enable_right_click_menu() #not implemented yet
 
 
@@ -710,6 +711,17 @@ def update():
 			if allow_privilege("gm"):
 				info_pane.paneconfig(tech_frame, height=tech_frame.winfo_reqheight())
 
+		if allow_privilege("gm"):
+			for address, stats in game.get_network_stats().items():
+				ip = stats["ip"]
+				if ip not in tech_frame:
+					continue
+				if stats["rtt"] is None:
+					tech_frame.set_row(ip, Address=address, Loss="{:.0%}".format(stats["loss_out"]))
+				else:
+					tech_frame.set_row(ip, Address=address, RTT="{:.0f} ms".format(stats["rtt"]),
+							Jitter="{:.0f} ms".format(stats["jitter"]), Loss="{:.0%}".format(stats["loss_out"]))
+
 		if "sectors" in updates:
 			map_iterator = updates["sectors"]
 			del state["sectors"]
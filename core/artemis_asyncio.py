@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+"""This is the asyncio variant of the Artemis Connector module.
+Instead of one thread per task, one event loop receives and dispatches the
+requests of all Artemis clients, broadcasts the game state and sends the heartbeats.
+The package codec and the request handling of artemis_connector are reused,
+so both variants behave the same towards Artemis and towards the engine.
+"""
+
+import asyncio
+import threading
+
+import core.artemis_connector as connector
+import core.engine_artemis as engine
+
+__author__ = "Pithlit"
+__version__	= 1.0
+
+
+class LoopEvent(connector.CoalescingEvent):
+	"""
+	A coalescing event the engine can set from any thread.
+	It wakes up the notify coroutine inside the event loop.
+	"""
+
+	def __init__(self, loop):
+		connector.CoalescingEvent.__init__(self)
+		self.loop = loop
+		self.loop_event = asyncio.Event()
+
+	def set(self):
+		connector.CoalescingEvent.set(self)
+		self.loop.call_soon_threadsafe(self.loop_event.set)
+
+	def clear(self):
+		connector.CoalescingEvent.clear(self)
+		self.loop_event.clear()
+
+	async def wait_async(self, timeout):
+		try:
+			await asyncio.wait_for(self.loop_event.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+
+
+class ArtemisProtocol(asyncio.DatagramProtocol):
+	"""Hands each datagram to the request handling of the artemis connector."""
+
+	def connection_made(self, transport):
+		self.transport = transport
+
+	def datagram_received(self, data, client):
+		try:
+			connector.handle_datagram(data, self.transport, client)
+		except Exception as exception:
+			print(exception)
+
+	def error_received(self, exception):
+		print(exception)
+
+
+async def notify(event):
+	"""
+	This coroutine replaces the notify thread.
+	It sends the map to all connected clients every BROADCAST_TIMEOUT seconds or when the event is set.
+	Changes that arrive in a burst are sent with a single broadcast.
+	"""
+	while True:
+		await event.wait_async(timeout=connector.BROADCAST_TIMEOUT)
+		delay = event.remaining()
+		while delay > 0:
+			await asyncio.sleep(delay)
+			delay = event.remaining()
+		event.collect()
+		for delay in connector.pace(connector.broadcast()):
+			await asyncio.sleep(delay)
+
+class HeartbeatWakeup:
+	"""
+	Replaces the HEARTBEAT_WAKEUP event of the artemis connector and the heartbeat thread.
+	heartbeat sends the heartbeats that are due and reschedules itself for the next one.
+	When something earlier is scheduled (a new client, a session to expire), set runs it right away.
+	"""
+
+	def __init__(self, loop):
+		self.loop = loop
+		self.handle = None	#of the next heartbeat call
+
+	def set(self):
+		self.loop.call_soon_threadsafe(self.heartbeat)
+
+	def clear(self):
+		pass
+
+	def heartbeat(self):
+		"""This callback replaces the heartbeat thread."""
+		if self.handle is not None:
+			self.handle.cancel()
+		timeout = connector.send_heartbeats()
+		if timeout is None:
+			timeout = connector.HEARTBEAT_INTERVAL
+		self.handle = self.loop.call_later(timeout, self.heartbeat)
+
+async def serve():
+	"""binds the artemis port and runs until the process ends"""
+	loop = asyncio.get_running_loop()
+	transport, _ = await loop.create_datagram_endpoint(ArtemisProtocol,
+													   local_addr=(connector.HOST or "0.0.0.0", connector.PORT))
+	connector.set_socket(transport, loop)
+	event = LoopEvent(loop)
+	connector.MAP_CHANGED_EVENT = event	#set by the request handling on Client-hello
+	engine.register_notification(event)
+	wakeup = HeartbeatWakeup(loop)
+	connector.HEARTBEAT_WAKEUP = wakeup
+	wakeup.heartbeat()
+	await notify(event)
+
+def start_server():
+	"""initializes and start this module"""
+	threading.Thread(target=asyncio.run, args=(serve(),)).start()
+	print("Server is listening for Artemis clients (asyncio).")
+	print("Choose 'Join War Server' in the Artemis server menu.")
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+"""This is the client side of the Artemis protocol.
+It composes the packages an Artemis Game Server sends to the warserver
+and reads the datagrams the warserver sends back.
+Tools use it to talk to the warserver (or to a relay) like Artemis does.
+"""
+
+import struct
+
+from core.artemis_connector import (PACKAGE_TYPES, PACKAGE_TYPES_ENCODE, PACKAGE_SUBTYPES,
+		PACKAGE_SUBTYPES_ENCODE, UINT16, HELLO_STRUCT, HEARTBEAT_ACK_STRUCT, SECTOR_STRUCT,
+		ENTER_STRUCT, LEAVE_STRUCT, KILL_STRUCT, STRLEN_STRUCT, DATA_HEADER_STRUCT)
+
+__author__ = "Pithlit"
+__version__	= 1.0
+
+TIMED_STRUCT = struct.Struct(">HHHH")	#flags, time, type, number
+SECTOR_DATA_STRUCT = struct.Struct("<HbbbbHxxHxxbxxxb")	#Data-Sector after the subtype, see compose_sector of the connector
+MAP_COLUMN_STRUCT = struct.Struct(">Hb")	#subtype and column of Data-Map
+MAP_SECTOR_STRUCT = struct.Struct("<bbbHbbH")	#one sector of Data-Map, followed by its name
+
+
+def compose_hello(time=0, connection_number=None):
+	"""
+	creates a Client-hello that asks the server for a connection number,
+	or to resume the connection with that number
+	"""
+	fields = (0, 0xFFFF if connection_number is None else connection_number, 0) + tuple(range(1, 18))
+	return (TIMED_STRUCT.pack(0x8000, time, PACKAGE_TYPES_ENCODE["Client-hello"], 1)
+			+ HELLO_STRUCT.pack(*fields) + b"\0\0")
+
+def compose_heartbeat(connection_number, number, time=0):
+	"""creates a heartbeat of the client"""
+	return TIMED_STRUCT.pack(0x8000 | (connection_number % 8) << 12, time, PACKAGE_TYPES_ENCODE["Heartbeat"], number)
+
+def compose_heartbeat_ack(connection_number, number, acked_time, time=0):
+	"""creates the answer to a heartbeat of the server"""
+	return (TIMED_STRUCT.pack(0x8000 | (connection_number % 8) << 12, time, PACKAGE_TYPES_ENCODE["Heartbeat-Ack"], number)
+			+ HEARTBEAT_ACK_STRUCT.pack(number, acked_time))
+
+def compose_bye(connection_number, number, time=0):
+	"""creates a Client-bye"""
+	return TIMED_STRUCT.pack(0x8000 | (connection_number % 8) << 12, time, PACKAGE_TYPES_ENCODE["Client-bye"], number) + b"\0\0"
+
+def compose_sector(connection_number, number, subtype, body, ship_name, time=0):
+	"""creates a Sector package. Use compose_enter, compose_leave or compose_kill instead."""
+	name = bytes(ship_name, "utf-8")
+	payload = body + STRLEN_STRUCT.pack(len(name)) + name
+	return (TIMED_STRUCT.pack(0x8000 | (connection_number % 8) << 12, time, PACKAGE_TYPES_ENCODE["Sector"], number)
+			+ SECTOR_STRUCT.pack(len(payload) + 2, PACKAGE_SUBTYPES_ENCODE[subtype]) + payload)
+
+def compose_enter(connection_number, number, x, y, ship_name, time=0):
+	"""creates the request to enter the sector x, y"""
+	return compose_sector(connection_number, number, "Sector-Enter", ENTER_STRUCT.pack(x, y), ship_name, time)
+
+def compose_leave(connection_number, number, id, ship_name, time=0):
+	"""creates the message that a sector was cleared"""
+	return compose_sector(connection_number, number, "Sector-Leave", LEAVE_STRUCT.pack(id, 0), ship_name, time)
+
+def compose_kill(connection_number, number, id, kills, ship_name, time=0):
+	"""creates the message that enemies were killed in a sector"""
+	return compose_sector(connection_number, number, "Sector-Kill", KILL_STRUCT.pack(id, 0, kills), ship_name, time)
+
+def read(data):
+	"""
+	Reads a datagram of the server.
+	Returns a list of (type, number, subtype, payload) tuples, one per package.
+	subtype is the data subtype of data packages and None for all others.
+	payload is the rest of the package after type and number.
+	"""
+	flags = UINT16.unpack_from(data)[0]
+	offset = 4 if flags & 0x8000 else 2
+	package_type, number = struct.unpack_from(">HH", data, offset)
+	package_type = PACKAGE_TYPES.get(package_type)
+	if package_type != "Data":
+		return [(package_type, number, None, bytes(data[offset+4:]))]
+	packages = []
+	while offset < len(data):
+		_, _, number, length = DATA_HEADER_STRUCT.unpack_from(data, offset)
+		offset += DATA_HEADER_STRUCT.size
+		subtype = PACKAGE_SUBTYPES.get(UINT16.unpack_from(data, offset)[0])
+		packages.append((package_type, number, subtype, bytes(data[offset:offset+length])))
+		offset += length
+	return packages
+
+def read_preamble(data):
+	"""Returns connection number and time of a datagram of the server. time is None, if it has none."""
+	flags = UINT16.unpack_from(data)[0]
+	time = UINT16.unpack_from(data, 2)[0] if flags & 0x8000 else None
+	return (flags >> 12) & 7, time
+
+def read_sector(payload):
+	"""Returns the sector to play of a Data-Sector payload, as read returns it, as dict"""
+	fields = SECTOR_DATA_STRUCT.unpack_from(payload, UINT16.size)
+	return dict(zip(("enemies", "rear_bases", "forward_bases", "fire_bases", "unknown",
+					 "seed", "id", "difficulty", "terrain"), fields))
+
+def read_map_col(payload):
+	"""Returns the column number and the sectors (as dicts) of a Data-Map payload, as read returns it"""
+	_, x = MAP_COLUMN_STRUCT.unpack_from(payload)
+	offset = MAP_COLUMN_STRUCT.size
+	sectors = []
+	while offset + MAP_SECTOR_STRUCT.size <= len(payload):
+		fields = MAP_SECTOR_STRUCT.unpack_from(payload, offset)
+		offset += MAP_SECTOR_STRUCT.size
+		sector = dict(zip(("rear_bases", "forward_bases", "fire_bases", "enemies", "hidden", "terrain"), fields))
+		sector["name"] = payload[offset:offset+fields[-1]].decode("utf-8", "replace")
+		offset += fields[-1]
+		sectors.append(sector)
+	return x, sectors
+
+def enterable(columns):
+	"""
+	Returns (x, y) of the sectors on the map that a ship may enter:
+	not hidden, with enemies, next to a sector without them (see engine_artemis._clientwall).
+	columns are the sector lists of read_map_col. The warserver may still refuse,
+	e.g. because of other ships or the fog of war.
+	"""
+	sectors = []
+	for x, column in enumerate(columns):
+		for y, sector in enumerate(column):
+			if sector["hidden"] or sector["enemies"] <= 0:
+				continue
+			for x_1, y_1 in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+				if 0 <= x_1 < len(columns) and 0 <= y_1 < len(columns[x_1]):
+					neighbour = columns[x_1][y_1]
+					if not neighbour["hidden"] and neighbour["enemies"] == 0:
+						sectors.append((x, y))
+						break
+	return sectors
@@ -3,24 +3,32 @@
 """This is the Artemis Connector module.
 It manages all the network connections to and from Artemis Game Servers (Clients).
 An Artemis Game Server can connect to this program with "Join Galactical War Server".
-This module consists of the udp socket server, request handlers and worker threads.
+This module consists of the udp socket, the request handling and worker threads.
 
 There are three instances for the communication with the artemis client:
-1 Response-thread: When a client sends a request, the response thread handles and answeres to it.
+1 Response-thread: When clients send requests, the response thread handles and answeres
+	all requests that are waiting on the socket in one batch.
 1 Notify-thread: When the game state changes (and every 5 seconds),
 	the notify thread sends the updates to all clients.
-n Heartbeat-threads: each one sends a heartbeat package to his client every 0.5 seconds.
-"""
+1 Heartbeat-thread: sends a heartbeat package to each client every 0.5 seconds,
+	unless other data was sent to that client in the meantime.
 
-#FIXME Bug: client connects and disconnects. Reconnect may fail!
+A client that times out or reports an error can resume its connection within SESSION_GRACE seconds.
+"""
 
-import copy
-import socketserver
+import collections
+import errno
+import heapq
+import itertools
+import socket as sockets	#"socket" names the socket objects in this module
+import select
 import threading
 import struct
 import time
 from warnings import warn
 
+import core.capture as capture
+import core.impairment as impairment
 import core.engine_artemis as engine
 
 __author__ = "Pithlit"
@@ -74,204 +82,970 @@ PACKAGE_SUBTYPES_ENCODE = dict()
 for key in PACKAGE_SUBTYPES:
 	PACKAGE_SUBTYPES_ENCODE[PACKAGE_SUBTYPES[key]] = key
 
+class TokenBucket:
+	"""
+	A rate limiter. It holds up to burst tokens and gains rate tokens per second.
+	take() spends a token if there is one, charge() spends tokens on credit.
+	"""
+
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	def take(self):
+		"""Returns True and spends a token, if one is available"""
+		with self.lock:
+			self.refill()
+			if self.tokens >= 1:
+				self.tokens -= 1
+				return True
+			return False
+
+	def charge(self, tokens):
+		"""Spends tokens, even if that leaves the bucket in debt"""
+		with self.lock:
+			self.refill()
+			self.tokens -= tokens
+
+	def delay(self):
+		"""Returns the seconds until the bucket is out of debt"""
+		with self.lock:
+			self.refill()
+			if self.tokens >= 0:
+				return 0
+			return -self.tokens / self.rate
+
+COALESCE_WINDOW = 0.1			#seconds without notification, before a burst counts as over
+COALESCE_MAX_LATENCY = 0.3		#seconds after the first notification of a burst, when the broadcast starts anyway
+
+class CoalescingEvent(threading.Event):
+	"""
+	An event that merges bursts of notifications into one.
+	The engine sets it for every single change. The waiting thread calls
+	remaining() until the burst is over and then collect(), which clears the event.
+	"""
+
+	def __init__(self):
+		threading.Event.__init__(self)
+		self.lock = threading.Lock()
+		self.pending = 0		#set() calls since the last collect()
+		self.first_set = None
+		self.last_set = None
+		self.notifications = 0	#set() calls in total
+		self.merged = 0			#notifications that did not cause a broadcast of their own
+		self.collected = 0		#bursts
+
+	def set(self):
+		with self.lock:
+			now = time.monotonic()
+			if self.first_set is None:
+				self.first_set = now
+			self.last_set = now
+			self.pending += 1
+			self.notifications += 1
+			threading.Event.set(self)
+
+	def remaining(self):
+		"""Returns the seconds to wait until the current burst counts as over"""
+		with self.lock:
+			if self.first_set is None:
+				return 0
+			now = time.monotonic()
+			quiet = self.last_set + COALESCE_WINDOW - now
+			deadline = self.first_set + COALESCE_MAX_LATENCY - now
+			return max(0, min(quiet, deadline))
+
+	def collect(self):
+		"""Ends the current burst. Returns the number of notifications in it."""
+		with self.lock:
+			self.clear()
+			pending = self.pending
+			self.pending = 0
+			self.first_set = None
+			if pending:
+				self.merged += pending - 1
+				self.collected += 1
+			return pending
+
+	def get_stats(self):
+		"""Returns the counters"""
+		with self.lock:
+			return {
+				"notifications":	self.notifications,
+				"merged":			self.merged,
+				"broadcasts":		self.collected,
+			}
+
+PRIORITY_ACK = 0			#acks and heartbeats
+PRIORITY_TURN_OVER = 1
+PRIORITY_STATUS = 2			#turn status, ships and answers to sector requests
+PRIORITY_MAP = 3
+OUTBOX_SEQUENCE = itertools.count()	#keeps packages of the same priority in order
+
+PACING_WINDOW = 0				#seconds to spread the sends of a broadcast over. 0 sends them at once.
+MAX_PACKETS_PER_SECOND = 2000	#budget of paced sends
+PACING_BUCKET = TokenBucket(MAX_PACKETS_PER_SECOND, MAX_PACKETS_PER_SECOND / 10)
+SEND_ERRORS = collections.Counter()	#failed sends by error
+
+RECEIVE_BATCH = 64		#datagrams handled at once
+MAX_INCOMING = 2048		#bytes; Artemis clients send much smaller datagrams
+
+SOCKET = None	#the bound server socket (or asyncio transport). All outbound traffic is sent from it.
+
 CONNECTIONS = dict()
 CONNECTIONS_LOCK = threading.RLock()
-MAP_CHANGED_EVENT = threading.Event()
+MAP_CHANGED_EVENT = CoalescingEvent()
+
+HEARTBEAT_INTERVAL = 0.5	#seconds
+HEARTBEAT_QUEUE = []		#heap of (due, sequence, client, connection), guarded by CONNECTIONS_LOCK
+HEARTBEAT_SEQUENCE = itertools.count()	#tie breaker for the heap
+HEARTBEAT_WAKEUP = threading.Event()
+STALE_AFTER = 3				#seconds without any datagram from a client, before broadcasts skip it
+CONNECTION_TIMEOUT = 20		#seconds without any datagram from a client, before it is disconnected
+REAPED = 0					#connections that timed out
+SESSION_GRACE = 60			#seconds a dropped connection may be resumed, before its ship is released
+SESSIONS = dict()			#(ip, connection number) -> (expiry, client, connection), guarded by CONNECTIONS_LOCK
+RESUMED = 0					#connections that were resumed
+
+MAX_CONNECTIONS = 256		#further clients are refused
+HELLO_RATE = 1				#Client-hellos per second and address
+HELLO_BURST = 3
+GLOBAL_HELLO_RATE = 20		#Client-hellos per second from all addresses
+GLOBAL_HELLO_BURST = 40
+HELLO_BUCKETS = dict()		#ip -> TokenBucket; only used by the response thread
+MAX_HELLO_BUCKETS = 1024
+GLOBAL_HELLO_BUCKET = TokenBucket(GLOBAL_HELLO_RATE, GLOBAL_HELLO_BURST)
+REFUSED = collections.Counter()	#refused Client-hellos by reason
+
+REPLAY_WINDOW = 256			#Sector package numbers remembered per connection
+REPLAY_WINDOW_MASK = (1 << REPLAY_WINDOW) - 1
+IS_INTERLUDE = False	#used by broadcast to send the turn over package
+KEYFRAME_INTERVAL = 30	#seconds between two broadcasts of the whole map to a client
+BROADCAST_INTERVAL = 6	#seconds between two broadcasts, if nothing changes
+IDLE_BROADCAST_INTERVAL = 48	#seconds; the interval doubles up to this while the game is idle
+COMBAT_STATUS_INTERVAL = 15	#seconds between turn and ships updates to clients inside a sector
+BROADCAST_TIMEOUT = BROADCAST_INTERVAL	#current interval, see broadcast
+LAST_BROADCAST_VERSION = None	#game version of the last broadcast
+
+#encoded payloads of the broadcast as (version, payload), see refresh_payloads
+PAYLOAD_LOCK = threading.Lock()
+PAYLOAD_CACHE = {
+	"game":		None,	#engine.get_game_version() of the last refresh
+	"turn_version":	None,
+	"sectors":	[[(None, b"")]*8 for x in range(8)],
+	"map_cols":	[(None, b"")]*8,
+	"ships":	(None, b""),
+	"turn":		(None, b""),
+}
+UINT16 = struct.Struct(">H")
+DATA_HEADER_STRUCT = struct.Struct(">HHHH")	#type, 0, number, payload length; follows the flags
+PACK_DATA = True		#pack several data packages into one datagram. Set to False for one package per datagram.
+MAX_DATAGRAM = 1400		#bytes; stays below the usual MTU of 1500, minus IP and UDP headers
+FRAME_BUFFERS = threading.local()	#reusable data headers, one per thread
+SENDMSG = hasattr(sockets.socket, "sendmsg")	#not available on windows
+CAPTURE = None	#a capture.Recorder, see start_capture
+IMPAIRMENT = None		#impairment parameters of all outbound traffic, see core/impairment.py
+IMPAIRED_CLIENTS = dict()	#ip -> impairment parameters of the traffic to that client
 
 
 def log(msg):
 	print(time.asctime() + " Connection " + str(msg))
 
-def heartbeat(ip, port):
+def heartbeat():
 	"""
-	This function is executed by each heartbeat-thread.
-	It sends a heartbeat package every 0.5 seconds.
+	This function is executed by the heartbeat thread.
+	It sends the heartbeat packages of all clients.
 	"""
-	client = (ip, port)
-	heartbeat_number = 0
+	while True:
+		timeout = send_heartbeats()
+		HEARTBEAT_WAKEUP.wait(timeout=timeout)
+
+def send_heartbeats():
+	"""
+	Sends all heartbeats that are due.
+	A heartbeat is skipped, if other data was sent to the client within the interval.
+	Clients that sent nothing for CONNECTION_TIMEOUT seconds are disconnected,
+	and the ships of sessions that were not resumed in time are released.
+	Returns the seconds until the next heartbeat or session expiry is due, or None if there is none.
+	"""
+	global REAPED
+	expired = []
 	with CONNECTIONS_LOCK:
-		con = CONNECTIONS.get(client)	#reference
-		socket = con["socket"]			#reference
-		connection_number = con["connection_number"]	#copy
-		terminate = con["terminate"]	#reference
-		#active = con["active"]			#reference
-	#from this point on the thread is initialized and does not read the connections state anymore.
-	while not terminate.wait(timeout=0.5):	#sleeps for 0.5 sec before returning False.
-		heartbeat_number = (heartbeat_number + 1) % 16**4
-		socket.sendto(compose_heartbeat(connection_number, heartbeat_number), client)
-		#active.wait()
-	socket.close()
+		now = time.monotonic()
+		while HEARTBEAT_QUEUE and HEARTBEAT_QUEUE[0][0] <= now:
+			due, sequence, client, con = heapq.heappop(HEARTBEAT_QUEUE)
+			if CONNECTIONS.get(client) is not con or con["heartbeat_sequence"] != sequence:
+				continue	#unregistered, reconnected or rescheduled
+			if now - con["last_seen"] >= CONNECTION_TIMEOUT:
+				expired.append(client)
+				REAPED += 1
+				continue
+			if now - con["last_sent"] >= HEARTBEAT_INTERVAL:
+				con["heartbeat_number"] = (con["heartbeat_number"] + 1) % 16**4
+				heartbeat = compose_heartbeat(con["heartbeat"], con["heartbeat_number"])
+				enqueue(client, "heartbeat", PRIORITY_ACK, heartbeat, raw=True)
+				flush(client, PRIORITY_ACK)
+				con["telemetry"]["heartbeats_sent"] += 1
+				con["last_sent"] = now
+			schedule_heartbeat(client, con, con["last_sent"] + HEARTBEAT_INTERVAL)
+		HEARTBEAT_WAKEUP.clear()
+		released = []
+		for key, (expiry, client, con) in list(SESSIONS.items()):
+			if expiry <= now:
+				del SESSIONS[key]
+				released.append(client)
+		dues = [expiry for expiry, _, _ in SESSIONS.values()]
+		if HEARTBEAT_QUEUE:
+			dues.append(HEARTBEAT_QUEUE[0][0])
+		timeout = min(dues) - now if dues else None
+	#the engine takes the game lock, so the connections lock must be released first
+	for client in expired:
+		log("from " + str(client) + " timed out.")
+		unregister_connection(client, resumable=True)
+	for client in released:
+		log("from " + str(client) + " was not resumed.")
+		engine.client_disconnected(client)	#releases the ship, unless the ip is connected elsewhere
+	return timeout
+
+def schedule_heartbeat(client, con, due):
+	"""adds the next heartbeat of a connection to the heartbeat queue"""
+	with CONNECTIONS_LOCK:
+		wakeup = not HEARTBEAT_QUEUE or due < HEARTBEAT_QUEUE[0][0]
+		con["heartbeat_sequence"] = next(HEARTBEAT_SEQUENCE)	#older entries of con are dropped
+		heapq.heappush(HEARTBEAT_QUEUE, (due, con["heartbeat_sequence"], client, con))
+	if wakeup:
+		HEARTBEAT_WAKEUP.set()
+
+def send(socket, data, client):
+	"""sends data to a client and remembers when, so the next heartbeat may be skipped"""
+	socket.sendto(data, client)
+	if CAPTURE is not None:
+		CAPTURE.record(capture.OUTBOUND, client, data)
+	con = CONNECTIONS.get(client)	#no lock
+	if con is not None:
+		con["last_sent"] = time.monotonic()
+		con["telemetry"]["datagrams_out"] += 1
+		count_out(con["telemetry"], classify(data), len(data))
+
+def send_data(client, *payloads):
+	"""
+	sends payloads as data packages to a client and returns the number of datagrams.
+	With PACK_DATA, as many data packages as fit into MAX_DATAGRAM bytes
+	share one datagram, otherwise each one is sent in a datagram of its own.
+	No lock is taken and the payloads are not copied:
+	the headers are patched into a buffer of the calling thread
+	and sent together with the (shared) payloads.
+	"""
+	con = CONNECTIONS.get(client)	#no lock
+	if con is None or not payloads:
+		return 0
+	headers = getattr(FRAME_BUFFERS, "headers", None)
+	if headers is None or len(headers) < len(payloads) * DATA_HEADER_STRUCT.size:
+		headers = FRAME_BUFFERS.headers = memoryview(bytearray(max(16, len(payloads)) * DATA_HEADER_STRUCT.size))
+	buffers = [con["data_flags"]]
+	length = UINT16.size
+	datagrams = 1
+	for i, payload in enumerate(payloads):
+		size = DATA_HEADER_STRUCT.size + len(payload)
+		if len(buffers) > 1 and (not PACK_DATA or length + size > MAX_DATAGRAM):
+			sendmsg(SOCKET, buffers, client)
+			datagrams += 1
+			buffers = [con["data_flags"]]
+			length = UINT16.size
+		header = headers[i*DATA_HEADER_STRUCT.size:(i+1)*DATA_HEADER_STRUCT.size]
+		DATA_HEADER_STRUCT.pack_into(header, 0, DATA, 0, next(con["data_numbers"]) % 0x10000, len(payload))
+		buffers.append(header)
+		buffers.append(payload)
+		length += size
+		count_out(con["telemetry"], PACKAGE_SUBTYPES.get(UINT16.unpack_from(payload)[0]), size)
+	sendmsg(SOCKET, buffers, client)
+	con["last_sent"] = time.monotonic()
+	con["telemetry"]["datagrams_out"] += datagrams
+	con["telemetry"]["bytes_out"] += UINT16.size * datagrams
+	return datagrams
+
+def enqueue(client, key, priority, payload, raw=False):
+	"""
+	Queues a package in the outbox of a client, until flush sends it.
+	A queued package with the same key is replaced, so a stale map column or status
+	is never sent after a newer one. key None never replaces anything.
+	raw packages are complete datagrams, all others are payloads of data packages.
+	"""
+	con = CONNECTIONS.get(client)	#no lock
+	if con is None:
+		return
+	sequence = next(OUTBOX_SEQUENCE)
+	if key is None:
+		key = sequence
+	with con["outbox_lock"]:
+		queued = con["outbox"].get(key)
+		if queued is not None:
+			sequence = queued[1]	#keep the place in the queue
+			con["superseded"] += 1
+		con["outbox"][key] = (priority, sequence, key, raw, payload)
+
+def flush(client, max_priority=PRIORITY_MAP):
+	"""
+	Sends the packages in the outbox of a client, most important first.
+	Packages with a priority value above max_priority stay queued.
+	Only one thread at a time sends to a client, so a package taken from the outbox
+	is on the wire before a newer one with the same key is taken by another thread.
+	Returns the number of datagrams sent.
+	"""
+	con = CONNECTIONS.get(client)	#no lock
+	if con is None:
+		return 0
+	with con["send_lock"]:
+		return send_outbox(client, con, max_priority)
+
+def send_outbox(client, con, max_priority):
+	"""takes the packages from the outbox and sends them. Called by flush with the send lock held."""
+	with con["outbox_lock"]:
+		outbox = con["outbox"]
+		if not outbox:
+			return 0
+		packages = sorted(package for package in outbox.values() if package[0] <= max_priority)
+		for package in packages:
+			del outbox[package[2]]
+	datagrams = 0
+	try:
+		payloads = []
+		for priority, sequence, key, raw, payload in packages:
+			if raw:
+				if payloads:
+					datagrams += send_data(client, *payloads)
+					payloads = []
+				send(SOCKET, payload, client)
+				datagrams += 1
+			else:
+				payloads.append(payload)
+		datagrams += send_data(client, *payloads)
+	except OSError as exception:
+		#a full send buffer is expected under load, so it is only counted
+		SEND_ERRORS[errno.errorcode.get(exception.errno, type(exception).__name__)] += 1
+		if exception.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+			print(exception)
+	return datagrams
+
+def reply(client, datagram):
+	"""sends a datagram right away, ahead of everything waiting in the outbox"""
+	enqueue(client, None, PRIORITY_ACK, datagram, raw=True)
+	flush(client, PRIORITY_ACK)
+
+def sendmsg(socket, buffers, client):
+	"""sends the buffers as one datagram (scatter-gather, where the platform supports it)"""
+	if SENDMSG and hasattr(socket, "sendmsg"):	#asyncio transports only have sendto
+		socket.sendmsg(buffers, (), 0, client)
+	else:
+		socket.sendto(b"".join(buffers), client)
+	if CAPTURE is not None:
+		CAPTURE.record(capture.OUTBOUND, client, b"".join(buffers))
+
+def start_capture(path):
+	"""records all datagrams from and to Artemis clients to the capture file path"""
+	global CAPTURE
+	CAPTURE = capture.Recorder(path)
+	print("Capturing Artemis traffic to " + path)
 
 def notify():
 	"""
 	This function is executed by the notify thread.
-	It sends the map to all connected clients every 6 seconds or when flag is set
+	It sends the map to all connected clients every BROADCAST_TIMEOUT seconds or when flag is set
+	Changes that arrive in a burst are sent with a single broadcast.
 	"""
-	is_interlude = False #used to send turn over package
 	while True:
-		MAP_CHANGED_EVENT.wait(timeout=6)
-		MAP_CHANGED_EVENT.clear()
-		#get whole map once
-		game_map = engine.get_map()
-		assert len(game_map) == 8
-		orig_map_col = []
-		for i in range(8):
-			orig_map_col.append(compose_map_col(i, game_map[i]))
-		unfinished_packages = []
+		MAP_CHANGED_EVENT.wait(timeout=BROADCAST_TIMEOUT)
+		delay = MAP_CHANGED_EVENT.remaining()
+		while delay > 0:
+			time.sleep(delay)
+			delay = MAP_CHANGED_EVENT.remaining()
+		MAP_CHANGED_EVENT.collect()
+		for delay in pace(broadcast()):
+			time.sleep(delay)
+
+def get_notify_stats():
+	"""
+	Returns how many change notifications were merged into how many broadcasts
+	and how often sending failed, by error.
+	"""
+	stats = MAP_CHANGED_EVENT.get_stats()
+	stats["send_errors"] = dict(SEND_ERRORS)
+	stats["broadcast_interval"] = BROADCAST_TIMEOUT
+	if CAPTURE is not None:
+		stats["capture"] = CAPTURE.get_stats()
+	if isinstance(SOCKET, impairment.ImpairedSocket):
+		stats["impairment"] = SOCKET.get_stats()
+	return stats
+
+def pace(clients):
+	"""
+	Sends the outboxes of the given clients.
+	With PACING_WINDOW, the clients are spread over that many seconds and
+	no more than MAX_PACKETS_PER_SECOND datagrams are sent.
+	This is a generator that yields the seconds the caller has to sleep in between,
+	so it can be used by threads and by coroutines.
+	"""
+	if not PACING_WINDOW:
+		for client in clients:
+			flush(client)
+		return
+	start = time.monotonic()
+	interval = PACING_WINDOW / max(len(clients), 1)
+	for i, client in enumerate(clients):
+		delay = max(start + i*interval - time.monotonic(), PACING_BUCKET.delay())
+		if delay > 0:
+			yield delay
+		PACING_BUCKET.charge(flush(client))
+
+def refresh_payloads():
+	"""
+	Re-encodes the parts of the broadcast that changed since the last call.
+	Each payload is cached with the engine version it was encoded from,
+	so in an idle game nothing is copied or encoded.
+	The engine lock is taken before the payload lock, like the response thread does,
+	which holds it when it calls this through sync_client.
+	Returns the turn status.
+	"""
+	with engine.batch(), PAYLOAD_LOCK:
+		game_version = engine.get_game_version()
+		if PAYLOAD_CACHE["game"] != game_version:
+			refresh_state_payloads()
+			PAYLOAD_CACHE["game"] = game_version
 		turn_status = engine.get_turn_status()
-		if turn_status["interlude"] != is_interlude:
-			#send turn over package
-			is_interlude = not is_interlude
-			unfinished_packages.append(compose_turn_over())
-		unfinished_packages.append(compose_turn_status(turn_status))
-		unfinished_packages.append(compose_ships(engine.get_ships()))
-
-		with CONNECTIONS_LOCK:
-			for client in CONNECTIONS:
-#				if CONNECTIONS[client]["active"].is_set():
-					socket = CONNECTIONS[client]["socket"]
-					#updates = engine.get_modified_map(client)
-					#updated_cols = {}
-					for package in unfinished_packages:
-						try:
-							socket.sendto(compose_data(client, package), client)
-						except Exception as exception:
-							print(exception)
-					#for x, y, k, v in sorted(updates):
-					#	if x not in updated_cols:
-					#		updated_cols[x] = copy.deepcopy(game_map[x])
-					#	if isinstance(v, (int, float)):
-					#		updated_cols[x][y][k] += v
-					#	else:
-					#		updated_cols[x][y][k] = v
-
-					for i in range(8):
-						try:
-							#if i in updated_cols:
-							#	socket.sendto(compose_data(client, compose_map_col(i, updated_cols[i])), client)
-							#else:
-								socket.sendto(compose_data(client, orig_map_col[i]), client)
-						except Exception as exception:
-							print(exception)
-
-
-
-def register_connection(client, socket, connection_number):
+		version = (PAYLOAD_CACHE["turn_version"], int(turn_status["remaining"]))
+		if PAYLOAD_CACHE["turn"][0] != version:
+			PAYLOAD_CACHE["turn"] = (version, compose_turn_status(turn_status))
+		return turn_status
+
+def refresh_state_payloads():
+	"""re-encodes the sectors, columns and ships with a new version. Called by refresh_payloads."""
+	versions = engine.get_versions()
+	for x in range(8):
+		column_changed = False
+		for y in range(8):
+			version = versions["map"][x][y]
+			if PAYLOAD_CACHE["sectors"][x][y][0] != version:
+				PAYLOAD_CACHE["sectors"][x][y] = (version, compose_map_sector(engine.get_sector(x, y)))
+				column_changed = True
+		if column_changed:
+			version = max(versions["map"][x])
+			fragments = [fragment for _, fragment in PAYLOAD_CACHE["sectors"][x]]
+			PAYLOAD_CACHE["map_cols"][x] = (version, compose_map_col_header(x) + b"".join(fragments))
+	if PAYLOAD_CACHE["ships"][0] != versions["ships"]:
+		PAYLOAD_CACHE["ships"] = (versions["ships"], compose_ships(engine.get_ships()))
+	PAYLOAD_CACHE["turn_version"] = versions["turn"]
+
+def broadcast():
+	"""
+	sends to each connected client what it shows.
+	Clients on the map screen get the turn status, the ships if they changed
+	and the map columns that changed since the client received them.
+	Every KEYFRAME_INTERVAL seconds they get the whole map, in case a column got lost.
+	Clients that were silent for STALE_AFTER seconds only get turn over packages.
+	Clients inside a sector do not show the map. They get turn status and ships
+	only every COMBAT_STATUS_INTERVAL seconds or when the turn changes,
+	and the map columns they missed when they are back on the map screen.
+	While nothing changes in the game, the interval between broadcasts doubles
+	up to IDLE_BROADCAST_INTERVAL.
+	Turn over packages are sent right away, everything else is queued in the outboxes.
+	Returns the clients, whose outboxes must be sent with pace.
+	"""
+	global IS_INTERLUDE, BROADCAST_TIMEOUT, LAST_BROADCAST_VERSION
+	turn_status = refresh_payloads()
+	map_cols = PAYLOAD_CACHE["map_cols"]
+	turn_version = PAYLOAD_CACHE["turn_version"]
+	ships_version = PAYLOAD_CACHE["ships"][0]
+	turn_over = False
+	if turn_status["interlude"] != IS_INTERLUDE:
+		#send turn over package
+		IS_INTERLUDE = not IS_INTERLUDE
+		turn_over = True
+	if PAYLOAD_CACHE["game"] == LAST_BROADCAST_VERSION:
+		BROADCAST_TIMEOUT = min(BROADCAST_TIMEOUT * 2, IDLE_BROADCAST_INTERVAL)
+	else:
+		BROADCAST_TIMEOUT = BROADCAST_INTERVAL
+		LAST_BROADCAST_VERSION = PAYLOAD_CACHE["game"]
+
+	combat_clients = engine.get_combat_clients()
+	now = time.monotonic()
+	with CONNECTIONS_LOCK:
+		for client, con in CONNECTIONS.items():
+			if turn_over:
+				enqueue(client, "turn_over", PRIORITY_TURN_OVER, TURN_OVER_PAYLOAD)
+			if now - con["last_seen"] >= STALE_AFTER:
+				continue	#catches up on the map, once it answers again
+			turn_changed = con["turn_version"] != turn_version
+			if client[0] in combat_clients:
+				if turn_changed or now - con["status_sent"] >= COMBAT_STATUS_INTERVAL:
+					enqueue(client, "turn", PRIORITY_STATUS, PAYLOAD_CACHE["turn"][1])
+					enqueue(client, "ships", PRIORITY_STATUS, PAYLOAD_CACHE["ships"][1])
+					con["turn_version"] = turn_version
+					con["ships_version"] = ships_version
+					con["status_sent"] = now
+				continue
+			#only columns the client has not seen yet, unless a keyframe is due
+			keyframe = con["last_keyframe"] is None or now - con["last_keyframe"] >= KEYFRAME_INTERVAL
+			if keyframe:
+				con["last_keyframe"] = now
+			enqueue(client, "turn", PRIORITY_STATUS, PAYLOAD_CACHE["turn"][1])
+			if keyframe or con["ships_version"] != ships_version:
+				enqueue(client, "ships", PRIORITY_STATUS, PAYLOAD_CACHE["ships"][1])
+			con["turn_version"] = turn_version
+			con["ships_version"] = ships_version
+			con["status_sent"] = now
+			for i in range(8):
+				version, payload = map_cols[i]
+				if keyframe or con["map_versions"][i] != version:
+					enqueue(client, ("map", i), PRIORITY_MAP, payload)
+					con["map_versions"][i] = version
+		clients = list(CONNECTIONS)
+	if turn_over:
+		for client in clients:
+			flush(client, PRIORITY_TURN_OVER)
+		if clients and turn_status.get("transition_started") is not None:
+			engine.turn_over_sent(turn_status["transition_started"], time.time(), len(clients))
+	return clients
+
+
+
+def register_connection(client, connection_number):
 	"""A Client just connected to the server.
-	Now we start a thread to please him.
-	The thread and the information it communicates with us are stored
-	in the global CONNECTIONS dict.
+	The information we communicate with him is stored
+	in the global CONNECTIONS dict and his heartbeats are scheduled.
+	No socket or thread is created per client.
 	Each client-port combination may only be connected onec at the same time.
 	Notice that a client can send more than one connection request over time.
 	"""
 	connection = dict()
-	already_exists = False
 	with CONNECTIONS_LOCK:
 		if client in CONNECTIONS:
 			connection = CONNECTIONS[client]
-			already_exists = True 
-			#connection["active"].set() # not used
-			return connection["connection_number"], connection["thread"]
+			return connection["connection_number"]
 		else:
 			CONNECTIONS[client] = connection
-	if connection_number is None:
-		connection_number = 0
-	connection["connection_number"] = connection_number
-	connection["data_number"] = 1
-	connection["last_sector_numbers"] = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-	connection["terminate"] = threading.Event()		#terminate is currently not used!
-	connection["active"] = threading.Event()
-	connection["socket"] = socket.dup()
-	thread = threading.Thread(target=heartbeat, args=(client))
-	connection["thread"] = thread
-	#connection["active"].set()
-
-	return connection_number, thread
-
-def unregister_connection(client):
-	"""A Client disconedted from the server"""
+		if connection_number is None:
+			connection_number = 0
+		connection["connection_number"] = connection_number
+		connection["data_numbers"] = itertools.count(1)	#next() is atomic, no lock needed
+		connection["data_flags"] = UINT16.pack((connection_number % 8) << 12)
+		connection["replay_window"] = (None, 0)	#highest Sector package number, bitmap; see check_replay
+		connection["map_versions"] = [None]*8	#versions of the map columns the client received
+		connection["last_keyframe"] = None
+		connection["turn_version"] = None	#of the last turn status sent
+		connection["ships_version"] = None	#of the last ships sent
+		connection["status_sent"] = 0		#time.monotonic() of the last turn status
+		connection["outbox"] = dict()	#key -> (priority, sequence, key, raw, payload), see enqueue
+		connection["outbox_lock"] = threading.Lock()
+		connection["send_lock"] = threading.Lock()	#held by flush while it sends, see flush
+		connection["superseded"] = 0
+		connection["telemetry"] = new_telemetry()
+		connection["heartbeat"] = compose_heartbeat_template(connection_number)
+		connection["heartbeat_number"] = 0
+		connection["last_sent"] = time.monotonic()
+		connection["last_seen"] = connection["last_sent"]	#of the last datagram from the client
+		schedule_heartbeat(client, connection, connection["last_sent"] + HEARTBEAT_INTERVAL)
+	return connection_number
+
+def set_socket(socket, loop=None):
+	"""
+	Sets the socket all packages are sent from.
+	It is shared by all connections, so no file descriptors are allocated per client.
+	With IMPAIRMENT or IMPAIRED_CLIENTS, the outbound traffic is impaired on purpose;
+	loop is the event loop of an asyncio transport.
+	"""
+	global SOCKET
+	if IMPAIRMENT is not None or IMPAIRED_CLIENTS:
+		socket = impairment.ImpairedSocket(socket, IMPAIRMENT or impairment.parse(""), loop)
+		for ip, parameters in IMPAIRED_CLIENTS.items():
+			socket.set_client(ip, parameters)
+		print("Impairing the traffic to Artemis clients.")
+	SOCKET = socket
+
+def admit(client):
+	"""
+	Decides if a Client-hello is handled. Refuses it if the address or all addresses together
+	sent too many hellos, or if MAX_CONNECTIONS clients are connected.
+	Refusals are counted in REFUSED.
+	"""
+	bucket = HELLO_BUCKETS.get(client[0])
+	if bucket is None:
+		if len(HELLO_BUCKETS) >= MAX_HELLO_BUCKETS:
+			for ip, old_bucket in list(HELLO_BUCKETS.items()):
+				old_bucket.refill()
+				if old_bucket.tokens >= old_bucket.burst:
+					del HELLO_BUCKETS[ip]	#as if it never sent anything
+			if len(HELLO_BUCKETS) >= MAX_HELLO_BUCKETS:
+				HELLO_BUCKETS.clear()
+		bucket = HELLO_BUCKETS[client[0]] = TokenBucket(HELLO_RATE, HELLO_BURST)
+	if not bucket.take():
+		REFUSED["address_rate"] += 1
+		return False
+	if client not in CONNECTIONS and len(CONNECTIONS) >= MAX_CONNECTIONS:	#no lock
+		REFUSED["full"] += 1
+		return False
+	if not GLOBAL_HELLO_BUCKET.take():
+		REFUSED["global_rate"] += 1
+		return False
+	return True
+
+def unregister_connection(client, resumable=False):
+	"""
+	A Client disconedted from the server.
+	If resumable, the connection is kept as session for SESSION_GRACE seconds
+	and the ship is released only if the client does not resume it by then.
+	"""
 	log("from " + str(client) + " unregistered.")
 	with CONNECTIONS_LOCK:
-		if client in CONNECTIONS:
-			con = CONNECTIONS.pop(client)
-			engine.disconnect_client(client)
-		else:
+		con = CONNECTIONS.pop(client, None)	#the heartbeat queue drops its entry lazily
+		if con is None:
 			return
-	con["terminate"].set()
+		if resumable and SESSION_GRACE > 0:
+			key = (client[0], con["connection_number"])
+			replaced = SESSIONS.get(key)
+			SESSIONS[key] = (time.monotonic() + SESSION_GRACE, client, con)
+			with con["outbox_lock"]:
+				con["outbox"].clear()
+			HEARTBEAT_WAKEUP.set()	#for the expiry
+			if replaced is None:
+				return
+			client = replaced[1]	#a session with the same number can not be resumed anymore
+	engine.client_disconnected(client)
 
-def check_sector_replay(client, sector_number):
-	"""Checks the package counter.
-		Returns False, if the package already arrived, but ack was lost.
-		Such packages must be ignored.
+def resume_connection(client, connection_number):
+	"""
+	A client said hello. If it is already connected with that number,
+	or dropped a connection with that number from the same ip less than SESSION_GRACE seconds ago,
+	that connection with all its counters is used on and True is returned.
 	"""
+	global RESUMED
 	with CONNECTIONS_LOCK:
-		if CONNECTIONS[client]["last_sector_numbers"][sector_number%10] < sector_number:
-			CONNECTIONS[client]["last_sector_numbers"][sector_number%10] = sector_number
-			return True
-		elif (sector_number < 10 and
-			  CONNECTIONS[client]["last_sector_numbers"][sector_number%10] > 0xffff-10):
-			CONNECTIONS[client]["last_sector_numbers"][sector_number%10] = sector_number
-			return True
-		else:
+		if client in CONNECTIONS:
+			return CONNECTIONS[client]["connection_number"] == connection_number
+		session = SESSIONS.pop((client[0], connection_number), None)
+		if session is None:
 			return False
+		_, old_client, con = session
+		CONNECTIONS[client] = con
+		now = time.monotonic()
+		con["last_seen"] = con["last_sent"] = now
+		RESUMED += 1
+		schedule_heartbeat(client, con, now + HEARTBEAT_INTERVAL)
+		return True
+
+def sync_client(client):
+	"""
+	Sends a client that just (re)connected the turn status, the ships and the map columns
+	it has not seen. The payloads are refreshed first, so the turn time is not
+	as old as the last broadcast, which may be IDLE_BROADCAST_INTERVAL ago.
+	Other clients are not affected. Later changes reach the client with the next broadcast.
+	"""
+	con = CONNECTIONS.get(client)	#no lock
+	if con is None:
+		return
+	refresh_payloads()
+	now = time.monotonic()
+	if con["last_keyframe"] is None:
+		con["last_keyframe"] = now	#it gets the whole map now
+	enqueue(client, "turn", PRIORITY_STATUS, PAYLOAD_CACHE["turn"][1])
+	enqueue(client, "ships", PRIORITY_STATUS, PAYLOAD_CACHE["ships"][1])
+	con["turn_version"] = PAYLOAD_CACHE["turn_version"]
+	con["ships_version"] = PAYLOAD_CACHE["ships"][0]
+	con["status_sent"] = now
+	for i in range(8):
+		version, payload = PAYLOAD_CACHE["map_cols"][i]
+		if con["map_versions"][i] != version:
+			enqueue(client, ("map", i), PRIORITY_MAP, payload)
+			con["map_versions"][i] = version
+	flush(client)
+
+def check_replay(con, number):
+	"""
+	Checks the number of a Sector package against the replay window of the connection.
+	Returns True, if the package is new. Returns False, if it already arrived
+	(and the ack got lost) or is older than the window. Such packages must be ignored.
+	Only the response thread uses the window, so no lock is needed.
+	"""
+	highest, bitmap = con["replay_window"]
+	if highest is None:
+		con["replay_window"] = (number, 1)
+		return True
+	delta = (number - highest) % 0x10000
+	if delta == 0:
+		return False
+	if delta < 0x8000:
+		#newer than all before, the window slides. Bit i stands for highest - i.
+		con["replay_window"] = (number, ((bitmap << delta) | 1) & REPLAY_WINDOW_MASK)
+		return True
+	age = 0x10000 - delta
+	if age >= REPLAY_WINDOW or bitmap >> age & 1:
+		return False
+	con["replay_window"] = (highest, bitmap | 1 << age)
+	return True
+
+def receive(socket):
+	"""
+	This function is executed by the response thread.
+	It waits until datagrams arrive and drains all of them from the non-blocking socket
+	into one reused buffer. Then they are handled as a batch.
+	"""
+	arena = memoryview(bytearray(RECEIVE_BATCH * MAX_INCOMING))
+	socket.setblocking(False)
+	while True:
+		select.select([socket], [], [])
+		batch = []
+		offset = 0
+		while len(batch) < RECEIVE_BATCH:
+			try:
+				nbytes, client = socket.recvfrom_into(arena[offset:offset+MAX_INCOMING])
+			except BlockingIOError:
+				break
+			except OSError as exception:
+				print(exception)	#e.g. windows reports unreachable clients here
+				continue
+			batch.append((arena[offset:offset+nbytes], client))
+			offset += nbytes
+		handle_batch(batch, socket)
 
-class ArtemisUDPHandler(socketserver.DatagramRequestHandler):
-	"""
-	The RequestHandler class for our server.
-	It is instantiated once per connection to the server, and must
-	override the handle() method to implement communication to the client.
-	"""
-
-	def handle(self):
-		"""
-		self.request consists of a pair of data and client socket, and since
-		there is no connection the client address must be given explicitly
-		when sending data back via sendto().
-		"""
-		data = self.request[0]
-		socket = self.request[1]
-		client = self.client_address
-		for package in dissect(data):
-			if package["type"] == "Client-hello":
-				number, thread = register_connection(client, socket, package.get("connection_number"))
+def handle_batch(batch, socket):
+	"""
+	Handles a list of (data, client) tuples.
+	Heartbeats and their acks are answered first and without the engine lock,
+	so they never wait for a turn transition.
+	For the rest of the batch, the engine lock is taken once instead of once per request,
+	and only if there is a rest.
+	"""
+	rest = []
+	for data, client in batch:
+		try:
+			if not handle_heartbeat(data, client):
+				rest.append((data, client))
+		except Exception as exception:
+			print("Exception while handling a datagram from " + str(client) + ": " + repr(exception))
+	if not rest:
+		return
+	with engine.batch():
+		for data, client in rest:
+			try:
+				handle_datagram(data, socket, client)
+			except Exception as exception:
+				print("Exception while handling a datagram from " + str(client) + ": " + repr(exception))
+
+def handle_heartbeat(data, client):
+	"""
+	Handles a datagram that holds nothing but a heartbeat or a heartbeat ack.
+	Returns False for all other datagrams, without looking further into them.
+	Needs no engine lock.
+	"""
+	heartbeat = dissect_heartbeat(data)
+	if heartbeat is None:
+		return False
+	if CAPTURE is not None:
+		CAPTURE.record(capture.INBOUND, client, data)
+	package_type, number, value = heartbeat
+	con = CONNECTIONS.get(client)	#no lock
+	if con is None:
+		warn("client not in CONNECTIONS list. Waiting for client to reconnect.")
+		return True
+	con["last_seen"] = time.monotonic()
+	count_in(con["telemetry"], len(data), ((package_type, number),))
+	if package_type == "Heartbeat-Ack":
+		heartbeat_acked(con["telemetry"], value)
+	else:
+		reply(client, value)
+	return True
+
+def handle_datagram(data, socket, client):
+	"""
+	Handles all packages of one datagram.
+	socket is the socket the datagram arrived on, e.g. an asyncio transport.
+	Replies are sent through the outbox of the client, see enqueue.
+	"""
+	if handle_heartbeat(data, client):
+		return
+	if CAPTURE is not None:
+		CAPTURE.record(capture.INBOUND, client, data)
+	packages = dissect(data)
+	con = CONNECTIONS.get(client)	#no lock
+	if con is not None:
+		con["last_seen"] = time.monotonic()
+		count_in(con["telemetry"], len(data), ((package.type, package.number) for package in packages))
+	for package in packages:
+		if package.type == "Client-hello":
+			if not admit(client):
+				continue	#Artemis repeats its hello
+			if resume_connection(client, package.connection_number):
+				number = package.connection_number
+				log("("+str(number)+") from " + str(client) + " resumed.")
+			else:
+				if client not in CONNECTIONS and not engine.client_connected(client):	#no lock
+					REFUSED["full"] += 1	#all connectors together are full
+					continue
+				number = register_connection(client, package.connection_number)
 				log("("+str(number)+") from " + str(client) + " registered.")
-				socket.sendto(compose_hello(number, package), client)
-				if not thread.is_alive():
-					thread.start()
-				MAP_CHANGED_EVENT.set()
-			elif package["type"] == "Error":
-				log("from "+str(client)+" reported Error")
+			reply(client, compose_hello(number, package))
+			sync_client(client)
+		elif package.type == "Error":
+			log("from "+str(client)+" reported Error")
+			unregister_connection(client, resumable=True)
+		elif client in CONNECTIONS:	#no lock
+			if package.type == "Client-bye":
+				log("from "+str(client)+" sent disconnect.")
+				reply(client, ack("Heartbeat-Ack", package))
 				unregister_connection(client)
-			elif client in CONNECTIONS:	#no lock
-				if package["type"] == "Client-bye":
-					log("from "+str(client)+" sent disconnect.")
-					socket.sendto(ack("Heartbeat-Ack", package), client)
-					unregister_connection(client)
-				elif package["type"] == "Heartbeat" or package["type"] == "?+Heartbeat":
-					#answer with ack
-					socket.sendto(ack("Heartbeat-Ack", package), client)
-				elif package["type"] == "Heartbeat-Ack":
-					pass
-				elif package["type"] == "Sector":
-					socket.sendto(ack("Sector-Ack", package), client)
-					if package["subtype"] == "Sector-Enter":
-						sector = engine.enter_sector(package["X"], package["Y"], package["Ship-Name"], client)
-						if sector is not None:
-							if "Ship-Name" in sector and sector["Ship-Name"] != package["Ship-Name"]:
-								socket.sendto(compose_data(client, compose_shipname(sector["Ship-Name"])), client)
-								package["Ship-Name"] = sector["Ship-Name"]
-							socket.sendto(compose_data(client, compose_sector(sector)), client)
-					elif package["subtype"] == "Sector-Leave":
-						engine.clear_sector(package["Ship-Name"], package["ID"], client)
-					elif package["subtype"] == "Sector-Kill":
-						if check_sector_replay(client, package["Number"]):
-							engine.kills_in_sector(package["Ship-Name"], package["ID"], package["Kills"], client)
-					else:
-						warn("unknown sector package")
+			elif package.type == "Heartbeat" or package.type == "?+Heartbeat":
+				#answer with ack
+				reply(client, ack("Heartbeat-Ack", package))
+			elif package.type == "Heartbeat-Ack":
+				heartbeat_acked(CONNECTIONS[client]["telemetry"], package.acked_time)
+			elif package.type == "Sector":
+				reply(client, ack("Sector-Ack", package))
+				con = CONNECTIONS[client]
+				if not check_replay(con, package.number):
+					con["telemetry"]["duplicates"][package.subtype] += 1
+					continue
+				if package.subtype == "Sector-Enter":
+					sector = engine.enter_sector(package.x, package.y, package.ship_name, client)
+					if sector is not None:
+						if "Ship-Name" in sector and sector["Ship-Name"] != package.ship_name:
+							enqueue(client, None, PRIORITY_STATUS, compose_shipname(sector["Ship-Name"]))
+							package.ship_name = sector["Ship-Name"]
+						enqueue(client, None, PRIORITY_STATUS, compose_sector(sector))
+						flush(client, PRIORITY_STATUS)
+				elif package.subtype == "Sector-Leave":
+					engine.clear_sector(package.ship_name, package.id, client)
+				elif package.subtype == "Sector-Kill":
+					engine.kills_in_sector(package.ship_name, package.id, package.kills, client)
 				else:
-					warn("unknown package")
+					warn("unknown sector package")
 			else:
-				warn("client not in CONNECTIONS list. Waiting for client to reconnect.")
+				warn("unknown package")
+		else:
+			warn("client not in CONNECTIONS list. Waiting for client to reconnect.")
+
+
+#Here follows network telemetry
+
+def new_telemetry():
+	"""Returns the counters of a new connection. They are updated without lock and may miss a count."""
+	return {
+		"connected":		time.monotonic(),
+		"rtt":				None,	#smoothed round trip time of heartbeats in ms
+		"jitter":			None,	#smoothed deviation of the round trip time in ms
+		"heartbeats_sent":	0,
+		"heartbeats_acked":	0,
+		"last_numbers":		dict(),	#package type -> last number received from the client
+		"lost_in":			0,		#packages missing in the numbering of the client
+		"duplicates":		collections.Counter(),	#repeated Sector packages by subtype
+		"datagrams_in":		0,
+		"bytes_in":			0,
+		"datagrams_out":	0,
+		"bytes_out":		0,
+		"packets_in":		collections.Counter(),	#by package type
+		"packets_out":		collections.Counter(),	#by package type or data subtype
+		"bytes_out_by_type":	collections.Counter(),
+	}
+
+def count_in(telemetry, nbytes, packages):
+	"""Counts a received datagram. packages are (type, number) tuples."""
+	telemetry["datagrams_in"] += 1
+	telemetry["bytes_in"] += nbytes
+	last_numbers = telemetry["last_numbers"]
+	for package_type, number in packages:
+		telemetry["packets_in"][package_type] += 1
+		if package_type == "Heartbeat-Ack":
+			continue	#numbered by our heartbeats, lost ones count in loss_out
+		last = last_numbers.get(package_type)
+		if last is not None:
+			gap = (number - last) % 0x10000
+			if gap >= 0x8000:
+				continue	#late or repeated package
+			if gap > 1:
+				telemetry["lost_in"] += gap - 1
+		last_numbers[package_type] = number
+
+def count_out(telemetry, package_type, nbytes):
+	"""Counts the bytes of a sent package. The caller counts the datagrams."""
+	telemetry["bytes_out"] += nbytes
+	telemetry["packets_out"][package_type] += 1
+	telemetry["bytes_out_by_type"][package_type] += nbytes
+
+def heartbeat_acked(telemetry, acked_time):
+	"""The client echoed the time of one of our heartbeats. Updates rtt and jitter like TCP does."""
+	telemetry["heartbeats_acked"] += 1
+	sample = (get_local_time() - acked_time) % 0x10000
+	if telemetry["rtt"] is None:
+		telemetry["rtt"] = sample
+		telemetry["jitter"] = sample / 2
+	else:
+		telemetry["jitter"] = 0.75 * telemetry["jitter"] + 0.25 * abs(telemetry["rtt"] - sample)
+		telemetry["rtt"] = 0.875 * telemetry["rtt"] + 0.125 * sample
+
+def get_connection_stats():
+	"""
+	Returns the number of active connections, of stale ones that are skipped
+	by broadcasts, of the connections that timed out so far, of the sessions
+	that may still be resumed, of the resumed ones and of the refused Client-hellos by reason.
+	"""
+	now = time.monotonic()
+	with CONNECTIONS_LOCK:
+		stale = sum(1 for con in CONNECTIONS.values() if now - con["last_seen"] >= STALE_AFTER)
+		return {
+			"active":	len(CONNECTIONS) - stale,
+			"stale":	stale,
+			"reaped":	REAPED,
+			"sessions":	len(SESSIONS),
+			"resumed":	RESUMED,
+			"refused":	dict(REFUSED),
+		}
+
+def get_network_stats():
+	"""
+	Returns the telemetry of all connections as dict,
+	keyed by "ip:port" of the client.
+	"""
+	now = time.monotonic()
+	stats = dict()
+	with CONNECTIONS_LOCK:
+		for client, con in CONNECTIONS.items():
+			telemetry = con["telemetry"]
+			seconds = max(now - telemetry["connected"], 0.001)
+			sent = telemetry["heartbeats_sent"]
+			received = sum(telemetry["packets_in"].values())
+			stats[client[0] + ":" + str(client[1])] = {
+				"ip":				client[0],
+				"port":				client[1],
+				"connection_number":	con["connection_number"],
+				"connected_seconds":	seconds,
+				"rtt":				telemetry["rtt"],
+				"jitter":			telemetry["jitter"],
+				"heartbeats_sent":	sent,
+				"heartbeats_acked":	telemetry["heartbeats_acked"],
+				"loss_out":			max(0, 1 - telemetry["heartbeats_acked"] / sent) if sent > 1 else 0.0,
+				"lost_in":			telemetry["lost_in"],
+				"duplicates":		dict(telemetry["duplicates"]),
+				"loss_in":			telemetry["lost_in"] / (received + telemetry["lost_in"]) if received else 0.0,
+				"datagrams_in":		telemetry["datagrams_in"],
+				"bytes_in":			telemetry["bytes_in"],
+				"datagrams_out":	telemetry["datagrams_out"],
+				"bytes_out":		telemetry["bytes_out"],
+				"datagrams_in_per_second":	telemetry["datagrams_in"] / seconds,
+				"bytes_in_per_second":		telemetry["bytes_in"] / seconds,
+				"datagrams_out_per_second":	telemetry["datagrams_out"] / seconds,
+				"bytes_out_per_second":		telemetry["bytes_out"] / seconds,
+				"packets_in":		dict(telemetry["packets_in"]),
+				"packets_out":		dict(telemetry["packets_out"]),
+				"bytes_out_by_type":	dict(telemetry["bytes_out_by_type"]),
+				"superseded":		con["superseded"],
+			}
+	return stats
 
 
 #Here follows package assambley
@@ -280,13 +1054,17 @@ def ack(subtype, orig_package):
 	"""creates an ack package to ack heartbeats or sectors"""
 	package_type = PACKAGE_TYPES_ENCODE[subtype]
 	assert PACKAGE_TYPES[package_type] == subtype
-	flags = orig_package["flags_connection_number"]	#no time
-	number = orig_package["Number"]
-	package_time = orig_package["preamble_time"]
-	package = struct.pack(">HHHHH", flags, package_type,
-						  number, number, package_time)	#yes, number two times
+	flags = orig_package.preamble.flags_connection_number	#no time
+	number = orig_package.number
+	package_time = orig_package.preamble.time or 0
+	package = ACK_STRUCT.pack(flags, package_type,
+							  number, number, package_time)	#yes, number two times
 	return package
 
+def get_local_time():
+	"""Returns the time field of packages: milliseconds since start, wrapped to 16 bits"""
+	return int((time.time()-SERVER_START_TIME) * 1000)%0x10000
+
 def compose_preamble(connection_number: int, local_time: bool,
 					 package_type: str, package_number) -> bytes:
 	"""Every package starts with this preamble"""
@@ -295,14 +1073,20 @@ def compose_preamble(connection_number: int, local_time: bool,
 	package_type = PACKAGE_TYPES_ENCODE[package_type]
 	if local_time:
 		flags |= 0x8000
-		local_time = int((time.time()-SERVER_START_TIME) * 1000)%0x10000
+		local_time = get_local_time()
 		return struct.pack(">HHHH", flags, local_time, package_type, package_number)
 	else:
 		return struct.pack(">HHHH", flags, package_type, 0, package_number)
 
-def compose_heartbeat(con_number, pack_number):
-	"""called by heartbeat threads"""
-	return compose_preamble(con_number, True, "Heartbeat", pack_number)
+def compose_heartbeat_template(con_number):
+	"""creates the reusable heartbeat package of a connection"""
+	return bytearray(compose_preamble(con_number, True, "Heartbeat", 0))
+
+def compose_heartbeat(template, pack_number):
+	"""called by the heartbeat thread. Patches time and number into the template."""
+	UINT16.pack_into(template, 2, get_local_time())
+	UINT16.pack_into(template, 6, pack_number)
+	return template
 
 def compose_hello(number, orig_package):
 	"""called when a client connects to the server"""
@@ -310,35 +1094,37 @@ def compose_hello(number, orig_package):
 	preamble = compose_preamble(number, True, "Server-hello", 1)
 	number = number % 8
 	number = number | number << 4
-	payload = struct.pack('>'+('H'*20), 0x0000, number, 0x0000, *orig_package["payload-1-echo"],
-						  0, 0, 0, 0, *orig_package["payload-3-echo"])
+	payload = struct.pack('>'+('H'*20), 0x0000, number, 0x0000, *orig_package.payload_1_echo,
+						  0, 0, 0, 0, *orig_package.payload_3_echo)
 	#print("HELLO: number:"+str(number_orig)+", True, 1, 0x0000, number:"+str(number)+", 0x0000, payload-1, 0, 0, 0, 0, payload-3")
 	return preamble + payload
 
 def compose_data(client, payload):
-	"""create a data package"""
-	with CONNECTIONS_LOCK:
-		con = CONNECTIONS[client]
-		con_number = con["connection_number"]
-		data_number = con["data_number"]
-		con["data_number"] += 1
-	preamble = compose_preamble(con_number, False, "Data", data_number)
-	return preamble + struct.pack(">H", len(payload)) + payload
+	"""create a data package. send_data sends one without composing it."""
+	con = CONNECTIONS[client]
+	header = DATA_HEADER_STRUCT.pack(DATA, 0, next(con["data_numbers"]) % 0x10000, len(payload))
+	return con["data_flags"] + header + payload
 
 def compose_map_col(index, column_data):
 	"""creates a package that contains information of one column of the map"""
-	subtype = PACKAGE_SUBTYPES_ENCODE["Data-Map"]
-	sectors = struct.pack(">Hb", subtype, index)
+	sectors = compose_map_col_header(index)
 	for sector_data in column_data:
-		sector = struct.pack("<bbbHbbH", sector_data["rear_bases"],
-							 sector_data["forward_bases"], sector_data["fire_bases"],
-							 sector_data["enemies"], sector_data["hidden"],
-							 TERRAIN_TYPES.get(sector_data["terrain"],0),
-							 len(sector_data["name"])
-							 ) + bytes(sector_data["name"], "utf-8")
-		sectors += sector
+		sectors += compose_map_sector(sector_data)
 	return sectors
 
+def compose_map_col_header(index):
+	"""creates the beginning of a map column package"""
+	return struct.pack(">Hb", PACKAGE_SUBTYPES_ENCODE["Data-Map"], index)
+
+def compose_map_sector(sector_data):
+	"""creates the part of a map column package that describes one sector"""
+	return struct.pack("<bbbHbbH", sector_data["rear_bases"],
+					   sector_data["forward_bases"], sector_data["fire_bases"],
+					   sector_data["enemies"], sector_data["hidden"],
+					   TERRAIN_TYPES.get(sector_data["terrain"],0),
+					   len(sector_data["name"])
+					   ) + bytes(sector_data["name"], "utf-8")
+
 def compose_sector(sector_data):
 	"""creates a sector for a client to play"""
 	subtype = struct.pack(">H", PACKAGE_SUBTYPES_ENCODE["Data-Sector"])
@@ -369,6 +1155,8 @@ def compose_turn_over():
 	"""creates a turn over package that stops the simulation for the client"""
 	return struct.pack(">H", PACKAGE_SUBTYPES_ENCODE["Data-Turn-Over"])
 
+TURN_OVER_PAYLOAD = compose_turn_over()
+
 def compose_shipname(name):
 	"""creates a package that changes the ships name"""
 	subtype = PACKAGE_SUBTYPES_ENCODE["Data-Ship-Name"]
@@ -377,118 +1165,186 @@ def compose_shipname(name):
 
 #Here follows package dissassembly
 
+class Preamble:
+	"""The preamble of a datagram. It is shared by all packages inside that datagram."""
+	__slots__ = ("flags", "time")
+
+	def __init__(self, flags, time):
+		self.flags = flags
+		self.time = time	#None, if the time flag is not set
+
+	@property
+	def flags_connection_number(self):
+		return self.flags & 0x7000
+
+class Package:
+	"""
+	One dissected Artemis package.
+	Which fields are set depends on type and subtype:
+		Client-hello:	connection_number, payload_1_echo, payload_2, payload_3_echo
+		?+Heartbeat:	payload
+		Heartbeat-Ack:	acked_time
+		Sector:			subtype, ship_name and x, y (Enter) or id (Leave) or id, kills (Kill)
+	"""
+	__slots__ = ("preamble", "type", "number", "subtype", "connection_number",
+				 "payload_1_echo", "payload_2", "payload_3_echo", "payload",
+				 "acked_time", "x", "y", "id", "kills", "ship_name")
+
+	def __init__(self, preamble, package_type, number):
+		self.preamble = preamble
+		self.type = package_type
+		self.number = number
+
+	def __repr__(self):
+		fields = ", ".join(k+"="+repr(getattr(self, k)) for k in self.__slots__[1:] if hasattr(self, k))
+		return "Package(" + fields + ")"
+
+#precompiled structs for dissect. Fields are unpacked in place, nothing is sliced.
+PREAMBLE_STRUCT = struct.Struct(">HH")		#flags, time
+HEADER_STRUCT = struct.Struct(">HH")		#type, number (or zero for Data)
+HELLO_STRUCT = struct.Struct(">HHH6H4H7H")	#0, connection number, 0, payload 1, payload 2, payload 3
+PAYLOAD_STRUCT = struct.Struct(">HHHH")
+HEARTBEAT_ACK_STRUCT = struct.Struct(">HH")	#number, acked time
+SECTOR_STRUCT = struct.Struct(">HH")		#length, subtype
+ENTER_STRUCT = struct.Struct("<BB")			#x, y
+LEAVE_STRUCT = struct.Struct("<HH")			#id, 0
+KILL_STRUCT = struct.Struct("<HHI")			#id, 0, kills
+STRLEN_STRUCT = struct.Struct("<H")
+ACK_STRUCT = struct.Struct(">HHHHH")		#flags, type, number, number, time
+
+DATA = PACKAGE_TYPES_ENCODE["Data"]
+HEARTBEAT = PACKAGE_TYPES_ENCODE["Heartbeat"]
+HEARTBEAT_PLUS = PACKAGE_TYPES_ENCODE["?+Heartbeat"]
+HEARTBEAT_ACK = PACKAGE_TYPES_ENCODE["Heartbeat-Ack"]
+
+def classify(data):
+	"""Returns the type of the first package in data without dissecting it."""
+	flags = UINT16.unpack_from(data)[0]
+	if flags & 0x8000:
+		return PACKAGE_TYPES.get(UINT16.unpack_from(data, 4)[0])
+	return PACKAGE_TYPES.get(UINT16.unpack_from(data, 2)[0])
+
+def dissect_heartbeat(data):
+	"""
+	Fast path for the most frequent datagrams.
+	If data is a single heartbeat, returns (type, number, ack to send).
+	If data is a single heartbeat ack, returns (type, number, acked time).
+	Returns None for everything else, such datagrams must be dissected.
+	"""
+	length = len(data)
+	if length != 8 and length != 12 and length != 16:
+		return None
+	flags, package_time, package_type, number = PAYLOAD_STRUCT.unpack_from(data)
+	if not flags & 0x8000:
+		return None
+	if (package_type == HEARTBEAT and length == 8) or (package_type == HEARTBEAT_PLUS and length == 16):
+		return (PACKAGE_TYPES[package_type], number,
+				ACK_STRUCT.pack(flags & 0x7000, HEARTBEAT_ACK, number, number, package_time))
+	if package_type == HEARTBEAT_ACK and length == 12:
+		acked_number, acked_time = HEARTBEAT_ACK_STRUCT.unpack_from(data, 8)
+		if acked_number == number:
+			return ("Heartbeat-Ack", number, acked_time)
+	return None
+
 def dissect(data):
 	"""
 	Dissects an Artemis package.
-	Returns a list of dicts, containing meaningful information of that package.
+	Returns a list of Package objects, containing meaningful information of that package.
 	Raises an exception if a packet could not be dissected.
 	"""
 	#We do no error checking here, since we use exceptions
-	preamble = dict()
-	flags = int.from_bytes(data[0:2], byteorder="big")
-	preamble["flags"] = flags
-	preamble["flags_time"] = flags_time = flags & 0x8000
-	preamble["flags_connection_number"] = flags & 0x7000
-	preamble["flags_unknown"] = flags & 0xfff
-	if flags_time != 0:
-		preamble["preamble_time"] = int.from_bytes(data[2:4], byteorder="big")
-		data = data[4:]
+	view = memoryview(data)
+	end = len(view)
+	flags, package_time = PREAMBLE_STRUCT.unpack_from(view)
+	if flags & 0x8000:
+		preamble = Preamble(flags, package_time)
+		offset = 4
 	else:
-		data = data[2:]
+		preamble = Preamble(flags, None)
+		offset = 2
 	retlist = []
-	#from now on data begins here
-	while data:	# while len(data) > 0
-		package = dict()
-		subtype = PACKAGE_TYPES[int.from_bytes(data[:2], byteorder="big")]	#raises KeyError
-		package["type"] = subtype
+	#from now on data begins at offset
+	while offset < end:
+		package_type, number = HEADER_STRUCT.unpack_from(view, offset)
+		subtype = PACKAGE_TYPES[package_type]	#raises KeyError
 		if subtype == "Data":
-			if int.from_bytes(data[2:4]) != 0:
+			if number != 0:
 				raise ValueError
-			package["Number"] = int.from_bytes(data[4:6], byteorder="big")
-			data = data[6:]
+			number = UINT16.unpack_from(view, offset+4)[0]
+			offset += 6
 		else:
-			package["Number"] = int.from_bytes(data[2:4], byteorder="big")
-			data = data[4:]
+			offset += 4
+		package = Package(preamble, subtype, number)
 
-		#from now on data begins here
 		if subtype == "Client-hello":
-
-#			package["payload"] = list(map(lambda t: t[0], struct.iter_unpack("<H", data)))
-#			print(package["payload"])
-
-			if int.from_bytes(data[0:2], byteorder="big") != 0:
-				raise ValueError
-			if int.from_bytes(data[2:4], byteorder="big") != 0xFFFF:
-				package["connection_number"] = int.from_bytes(data[2:4], byteorder="big")
-			if int.from_bytes(data[4:6], byteorder="big") != 0:
-				raise ValueError
-
-			package["payload-1-echo"] = list(map(lambda t: t[0], struct.iter_unpack(">H", data[6:18])))
-			package["payload-2"] = list(map(lambda t: t[0], struct.iter_unpack(">H", data[18:26])))
-			package["payload-3-echo"] = list(map(lambda t: t[0], struct.iter_unpack(">H", data[26:40])))
-			if int.from_bytes(data[40:], byteorder="big") != 0:
+			fields = HELLO_STRUCT.unpack_from(view, offset)
+			if fields[0] != 0 or fields[2] != 0:
 				raise ValueError
+			if fields[1] != 0xFFFF:
+				package.connection_number = fields[1]
+			else:
+				package.connection_number = None
 			#Dont know what all this means yet.
-			#print("PREAMBLE: {flags_time: " + str(hex(preamble["flags_time"])) +", flags_connection_number" + str(hex(preamble["flags_connection_number"])) + ", flags_unknown:" + str(hex(preamble["flags_unknown"])) + ", preamble_time: " + str(preamble.get("time")) +"}" )
-			#print("PACKAGE: " + str(package))
-			data = []
-		elif subtype == "Client-bye":
-			if int.from_bytes(data[0:], byteorder="big") != 0:
+			package.payload_1_echo = fields[3:9]
+			package.payload_2 = fields[9:13]
+			package.payload_3_echo = fields[13:20]
+			if any(view[offset+HELLO_STRUCT.size:]):
 				raise ValueError
-			data = []
-		elif subtype == "Error":
-			if int.from_bytes(data[0:], byteorder="big") != 0:
+			offset = end
+		elif subtype == "Client-bye" or subtype == "Error":
+			if any(view[offset:]):
 				raise ValueError
-			data = []
+			offset = end
 		elif subtype == "Heartbeat":
 			pass
 		elif subtype == "?+Heartbeat":
-			package["payload-as-uint16-list"] = list(struct.unpack(">HHHH", data[0:8]))
-			data = data[8:]
+			package.payload = PAYLOAD_STRUCT.unpack_from(view, offset)
+			offset += 8
 		elif subtype == "Heartbeat-Ack":
-			if int.from_bytes(data[0:2], byteorder="big") != package["Number"]:
+			acked_number, package.acked_time = HEARTBEAT_ACK_STRUCT.unpack_from(view, offset)
+			if acked_number != number:
 				raise ValueError
-			package["acked-time"] = int.from_bytes(data[2:4], byteorder="big")
-			data = data[4:]
+			offset += 4
 		elif subtype == "Sector":
-			#length = int.from_bytes(data[0:2], byteorder="big")
-			subsubtype = PACKAGE_SUBTYPES[int.from_bytes(data[2:4], byteorder="big")]	#raises KeyError
-			package["subtype"] = subsubtype
-			data = data[4:]
+			length, subsubtype = SECTOR_STRUCT.unpack_from(view, offset)
+			subsubtype = PACKAGE_SUBTYPES[subsubtype]	#raises KeyError
+			package.subtype = subsubtype
+			offset += 4
 			if subsubtype == "Sector-Enter":
-				package["X"] = int(data[0])
-				package["Y"] = int(data[1])
-				data = data[2:]
+				package.x, package.y = ENTER_STRUCT.unpack_from(view, offset)
+				offset += 2
 			elif subsubtype == "Sector-Leave":
-				package["ID"] = int.from_bytes(data[0:2], byteorder="little")
-				if int.from_bytes(data[2:4], byteorder="big") != 0:
+				package.id, zero = LEAVE_STRUCT.unpack_from(view, offset)
+				if zero != 0:
 					raise ValueError
-				data = data[4:]
+				offset += 4
 			elif subsubtype == "Sector-Kill":
-				package["ID"] = int.from_bytes(data[0:2], byteorder="little")
-				if int.from_bytes(data[2:4], byteorder="big") != 0:
+				package.id, zero, package.kills = KILL_STRUCT.unpack_from(view, offset)
+				if zero != 0:
 					raise ValueError
-				package["Kills"] = int.from_bytes(data[4:8], byteorder="little")
-				data = data[8:]
+				offset += 8
 			else:
 				warn("WTF?")
-			strlen = int.from_bytes(data[0:2], byteorder="little")
-			#print("Ship-Name ("+str(strlen)+"): " + str(data[2:strlen+2]))
-			package["Ship-Name"] = data[2:strlen+2].decode(encoding="utf-8")
-			data = data[strlen+2:]
-		package.update(preamble)
+			strlen = STRLEN_STRUCT.unpack_from(view, offset)[0]
+			package.ship_name = str(view[offset+2:offset+2+strlen], "utf-8")
+			offset += strlen+2
 		retlist.append(package)
 	return retlist
 
 
-SERVER = socketserver.UDPServer((HOST, PORT), ArtemisUDPHandler)	#Blocking.
-#There is also ThreadingUDPServer that creates a new thread for each Request
-
-
-def start_server():
-	"""initializes and start this module"""
+def start_server(reuse_port=False):
+	"""
+	initializes and start this module.
+	With reuse_port, other processes may bind the same port, see artemis_sharding.
+	"""
+	socket = sockets.socket(sockets.AF_INET, sockets.SOCK_DGRAM)
+	if reuse_port:
+		socket.setsockopt(sockets.SOL_SOCKET, sockets.SO_REUSEPORT, 1)
+	socket.bind((HOST, PORT))
+	set_socket(socket)
 	engine.register_notification(MAP_CHANGED_EVENT)
 	threading.Thread(target=notify).start()
-	threading.Thread(target=SERVER.serve_forever).start()
+	threading.Thread(target=heartbeat).start()
+	threading.Thread(target=receive, args=(socket,)).start()
 	print("Server is listening for Artemis clients.")
 	print("Choose 'Join War Server' in the Artemis server menu.")
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+
+"""This is the relay module.
+A relay serves the Artemis clients of one LAN segment or host, like a worker of
+artemis_sharding does, but it runs anywhere and connects to the warserver over TCP.
+Over that one connection it forwards the requests that change the game (enter, kill, clear, bye)
+and receives the snapshots of the game state, from which it encodes its broadcasts.
+The relay itself keeps no game state.
+
+The connection is a Channel: length prefixed JSON messages, so neither side unpickles what
+the other one sends. Before anything else, both sides prove that they know the authkey, see authenticate.
+"""
+
+import builtins
+import hashlib
+import hmac
+import json
+import os
+import socket as sockets
+import struct
+import threading
+import time
+from multiprocessing import AuthenticationError
+
+import core.artemis_connector as connector
+import core.artemis_sharding as sharding
+import core.engine_artemis as engine
+
+__author__ = "Pithlit"
+__version__	= 1.0
+
+RELAY_PORT = 3001
+CONNECT_TIMEOUT = 10	#seconds a relay tries to reach the warserver
+HANDSHAKE_TIMEOUT = 5	#seconds the other side has to authenticate
+CHALLENGE_SIZE = 32		#random bytes each side has to sign
+MAX_MESSAGE = 16 * 1024**2	#bytes; a longer message ends the connection
+LENGTH = struct.Struct(">I")
+
+
+class Channel:
+	"""
+	A TCP connection between the warserver and a relay.
+	It is used like the pipe of a worker (send, recv, close), but the messages are JSON,
+	see encode and decode. recv raises EOFError when the connection is closed or the message is malformed.
+	"""
+
+	def __init__(self, socket):
+		self.socket = socket
+		self.peer = socket.getpeername()
+		socket.setsockopt(sockets.IPPROTO_TCP, sockets.TCP_NODELAY, 1)	#calls are small and wait for their result
+
+	def send_bytes(self, data):
+		self.socket.sendall(LENGTH.pack(len(data)) + data)
+
+	def recv_bytes(self):
+		length, = LENGTH.unpack(self.recv_exactly(LENGTH.size))
+		if length > MAX_MESSAGE:
+			raise EOFError("message of " + str(length) + " bytes from " + str(self.peer))
+		return self.recv_exactly(length)
+
+	def recv_exactly(self, size):
+		data = bytearray()
+		while len(data) < size:
+			chunk = self.socket.recv(size - len(data))
+			if not chunk:
+				raise EOFError("connection closed by " + str(self.peer))
+			data += chunk
+		return bytes(data)
+
+	def send(self, message):
+		self.send_bytes(json.dumps(encode(message), separators=(",", ":")).encode("utf-8"))
+
+	def recv(self):
+		data = self.recv_bytes()
+		try:
+			return decode(json.loads(data))
+		except (ValueError, TypeError, KeyError, IndexError) as exception:
+			raise EOFError("malformed message from " + str(self.peer) + ": " + str(exception))
+
+	def shutdown(self):
+		"""ends the connection, also for a thread that is blocked in send or recv"""
+		try:
+			self.socket.shutdown(sockets.SHUT_RDWR)
+		except OSError:
+			pass	#not connected anymore
+
+	def close(self):
+		self.socket.close()
+
+def encode(message):
+	"""
+	Returns a message of artemis_sharding as it is sent in JSON:
+	the sectors of a snapshot as [x, y, sector] list, the combat clients as list,
+	an exception of a result as its type name and message.
+	"""
+	if message[0] == "snapshot":
+		snapshot = dict(message[1])
+		snapshot["sectors"] = [[x, y, sector] for (x, y), sector in snapshot["sectors"].items()]
+		snapshot["combat"] = list(snapshot["combat"])
+		return ["snapshot", snapshot]
+	if message[0] == "result" and not message[2]:
+		_, number, ok, exception = message
+		return ["result", number, ok, {"type": type(exception).__name__, "message": str(exception)}]
+	return message
+
+def decode(message):
+	"""
+	Reverses encode. The arguments of calls that arrive as lists, like client addresses, become tuples again.
+	Exceptions that are not builtin arrive as RuntimeError.
+	"""
+	if message[0] == "snapshot":
+		snapshot = message[1]
+		snapshot["sectors"] = {(x, y): sector for x, y, sector in snapshot["sectors"]}
+		snapshot["combat"] = set(snapshot["combat"])
+		return ("snapshot", snapshot)
+	if message[0] == "result":
+		_, number, ok, value = message
+		if not ok:
+			exception_type = getattr(builtins, value["type"], None)
+			if not (isinstance(exception_type, type) and issubclass(exception_type, Exception)):
+				exception_type = RuntimeError
+			value = exception_type(value["message"])
+		return ("result", number, ok, value)
+	if message[0] == "call":
+		_, number, name, args = message
+		return ("call", number, name, tuple(tuple(arg) if isinstance(arg, list) else arg for arg in args))
+	if message[0] == "stats":
+		return tuple(message)
+	raise ValueError("unknown message " + str(message[0]))
+
+def sign(authkey, role, challenge):
+	return hmac.new(authkey, role + challenge, hashlib.sha256).digest()
+
+def authenticate(channel, authkey, warserver):
+	"""
+	Both sides send a random challenge and answer the other one with its HMAC under authkey,
+	so the key itself is never sent. The role is signed, too, so an answer can not be reflected.
+	Raises AuthenticationError, if the other side does not know the key.
+	"""
+	own, other = (b"warserver", b"relay") if warserver else (b"relay", b"warserver")
+	challenge = os.urandom(CHALLENGE_SIZE)
+	channel.send_bytes(challenge)
+	their_challenge = channel.recv_bytes()
+	if len(their_challenge) != CHALLENGE_SIZE:
+		raise AuthenticationError("challenge of " + str(len(their_challenge)) + " bytes")
+	channel.send_bytes(sign(authkey, own, their_challenge))
+	if not hmac.compare_digest(channel.recv_bytes(), sign(authkey, other, challenge)):
+		raise AuthenticationError("wrong authkey")
+
+def parse_address(address, port=RELAY_PORT):
+	"""Returns (host, port) of "host:port", "host" or ":port" """
+	host, _, port_string = address.partition(":")
+	return (host, int(port_string) if port_string else port)
+
+def accept(listener, authkey):
+	"""This function is executed by the relay listener thread of the warserver."""
+	while True:
+		try:
+			socket, address = listener.accept()
+		except OSError as exception:
+			print("Relay refused: " + str(exception))
+			continue
+		threading.Thread(target=handshake, args=(socket, address, authkey), daemon=True).start()
+
+def handshake(socket, address, authkey):
+	"""This function is executed by a thread per relay, until it is authenticated."""
+	try:
+		socket.settimeout(HANDSHAKE_TIMEOUT)
+		channel = Channel(socket)
+		authenticate(channel, authkey, warserver=True)
+		socket.settimeout(None)
+	except (AuthenticationError, EOFError, OSError) as exception:
+		print("Relay refused from " + str(address) + ": " + str(exception))
+		socket.close()
+		return
+	print("Relay connected from " + str(address))
+	sharding.add_worker(None, channel, tag=address[0] + ":" + str(address[1]) + "/")
+
+def listen(address, authkey):
+	"""
+	Called by the warserver: accepts relays on address (host, port) that know authkey.
+	The --max_connections of the warserver count for its own clients and those of all relays together.
+	"""
+	if not authkey:
+		raise ValueError("relays can not be accepted without an authkey")
+	listener = sockets.create_server(address)
+	engine.MAX_CONNECTIONS = connector.MAX_CONNECTIONS
+	sharding.start_publisher()
+	threading.Thread(target=accept, args=(listener, authkey), daemon=True).start()
+	print("Listening for relays on " + str(address[0] or "0.0.0.0") + ":" + str(address[1]))
+
+def connect(address, authkey):
+	"""Connects to the warserver and authenticates. Retries for CONNECT_TIMEOUT seconds."""
+	deadline = time.monotonic() + CONNECT_TIMEOUT
+	while True:
+		try:
+			socket = sockets.create_connection(address, timeout=HANDSHAKE_TIMEOUT)
+			break
+		except ConnectionRefusedError:
+			if time.monotonic() > deadline:
+				raise
+			time.sleep(0.5)
+	channel = Channel(socket)
+	authenticate(channel, authkey, warserver=False)
+	socket.settimeout(None)
+	return channel
+
+def start_relay(address, authkey, settings):
+	"""Called by start_relay.py: connects to the warserver and serves Artemis clients on connector.PORT"""
+	pipe = connect(address, authkey)
+	print("Relay connected to warserver at " + str(address[0]) + ":" + str(address[1]))
+	settings = dict(settings)
+	for name in sharding.SETTINGS:
+		settings.setdefault(name, getattr(connector, name))
+	settings.setdefault("MAX_PACKETS_PER_SECOND", connector.MAX_PACKETS_PER_SECOND)
+	sharding.worker(pipe, settings, reuse_port=False)
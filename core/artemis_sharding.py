@@ -0,0 +1,459 @@
+#!/usr/bin/python3
+
+"""This is the multi-process variant of the Artemis Connector module.
+Several worker processes bind the artemis port with SO_REUSEPORT,
+so the kernel spreads the Artemis clients over them by address.
+Each worker runs the artemis connector for its own clients:
+it dissects the requests, answers acks and heartbeats and encodes the broadcasts.
+
+The game state stays in this (the main) process. Each worker talks to it over a pipe:
+requests that change the game state are forwarded to the engine and answered,
+and a snapshot of what the broadcasts need is published to all workers whenever the game changes.
+"""
+
+import collections
+import itertools
+import multiprocessing
+import os
+import queue
+import socket as sockets
+import threading
+import time
+
+import core.artemis_connector as connector
+import core.engine_artemis as engine
+
+__author__ = "Pithlit"
+__version__	= 1.0
+
+#connector settings that are copied into the workers
+SETTINGS = (
+	"HOST", "PORT",
+	"KEYFRAME_INTERVAL", "BROADCAST_INTERVAL", "BROADCAST_TIMEOUT",
+	"IDLE_BROADCAST_INTERVAL", "COMBAT_STATUS_INTERVAL", "STALE_AFTER", "CONNECTION_TIMEOUT",
+	"MAX_CONNECTIONS", "HELLO_RATE", "HELLO_BURST", "SESSION_GRACE",
+	"PACK_DATA", "PACING_WINDOW", "COALESCE_WINDOW", "COALESCE_MAX_LATENCY",
+	"IMPAIRMENT", "IMPAIRED_CLIENTS",
+)
+
+#engine functions the workers may call
+CALLS = ("enter_sector", "clear_sector", "kills_in_sector",
+		 "client_connected", "client_disconnected", "turn_over_sent")
+#those of them whose last argument is the client
+CLIENT_CALLS = ("enter_sector", "clear_sector", "kills_in_sector",
+				"client_connected", "client_disconnected")
+
+#connector stats the main process may ask the workers for, see collect_stats
+STATS = {
+	"network":		connector.get_network_stats,
+	"connections":	connector.get_connection_stats,
+	"notify":		connector.get_notify_stats,
+}
+STATS_TIMEOUT = 2	#seconds to wait for the stats of all workers
+
+CAPTURE_PATH = None	#each worker captures its traffic to CAPTURE_PATH.<pid>
+
+TURN_REFRESH = 1	#seconds between two snapshots, if only the turn time runs down
+MAX_QUEUED = 32		#messages a worker or relay may fall behind, before it is dropped
+
+WORKERS = []		#Remote of each worker or relay
+PUBLISH_LOCK = threading.Lock()	#keeps the snapshots of all workers in the same order
+PUBLISHED = [[None]*8 for x in range(8)]	#versions of the sectors the workers got
+PUBLISHER = None	#the event of the publisher thread, once it runs
+STATS_NUMBERS = itertools.count()
+STATS_ANSWERS = dict()	#request number -> [(tag, stats)] of the workers that answered
+STATS_ARRIVED = threading.Condition()
+
+
+#Here follows the worker side
+
+class EngineProxy:
+	"""
+	Replaces the engine module inside a worker.
+	The getters answer from the last snapshot, the other calls are forwarded to the main process.
+	"""
+
+	def __init__(self, pipe):
+		self.pipe = pipe
+		self.send_lock = threading.Lock()
+		self.lock = threading.RLock()	#stands in for the game lock in batch()
+		self.call_numbers = itertools.count()
+		self.results = dict()			#call number -> (ok, value)
+		self.results_changed = threading.Condition()
+		self.notifications = []
+		self.snapshot = {
+			"game":		None,
+			"versions":	None,
+			"sectors":	[[None]*8 for x in range(8)],
+			"ships":	[],
+			"turn":		None,
+			"combat":	set(),
+		}
+		self.first_snapshot = threading.Event()
+
+	def listen(self):
+		"""This function is executed by the listener thread of the worker."""
+		while True:
+			try:
+				message = self.pipe.recv()
+			except (EOFError, OSError):
+				os._exit(0)	#the main process is gone
+			if message[0] == "snapshot":
+				self.apply(message[1])
+			elif message[0] == "stats":
+				_, number, name = message
+				with self.send_lock:
+					self.pipe.send(("stats", number, STATS[name]()))
+			else:
+				_, number, ok, value = message
+				with self.results_changed:
+					self.results[number] = (ok, value)
+					self.results_changed.notify_all()
+
+	def apply(self, snapshot):
+		"""merges a snapshot and notifies the connector, if the game changed"""
+		changed = snapshot["game"] != self.snapshot["game"]
+		for (x, y), sector in snapshot.pop("sectors").items():
+			self.snapshot["sectors"][x][y] = sector
+		self.snapshot.update(snapshot)
+		self.first_snapshot.set()
+		if changed:
+			for event in self.notifications:
+				event.set()
+
+	def call(self, name, *args):
+		"""forwards a call to the engine of the main process and waits for the result"""
+		number = next(self.call_numbers)
+		with self.send_lock:
+			self.pipe.send(("call", number, name, args))
+		with self.results_changed:
+			while number not in self.results:
+				self.results_changed.wait()
+			ok, value = self.results.pop(number)
+		if not ok:
+			raise value
+		return value
+
+	def get_game_version(self):
+		return self.snapshot["game"]
+
+	def get_versions(self):
+		return self.snapshot["versions"]
+
+	def get_sector(self, x, y):
+		return self.snapshot["sectors"][x][y]
+
+	def get_ships(self):
+		return self.snapshot["ships"]
+
+	def get_turn_status(self):
+		return self.snapshot["turn"]
+
+	def get_combat_clients(self):
+		return self.snapshot["combat"]
+
+	def enter_sector(self, x, y, shipname, client):
+		return self.call("enter_sector", x, y, shipname, client)
+
+	def clear_sector(self, shipname, id, client):
+		return self.call("clear_sector", shipname, id, client)
+
+	def kills_in_sector(self, shipname, id, kills, client):
+		return self.call("kills_in_sector", shipname, id, kills, client)
+
+	def client_connected(self, client):
+		return self.call("client_connected", client)
+
+	def client_disconnected(self, client):
+		return self.call("client_disconnected", client)
+
+	def turn_over_sent(self, started, sent, clients):
+		return self.call("turn_over_sent", started, sent, clients)
+
+	def batch(self):
+		return self.lock
+
+	def register_notification(self, event):
+		self.notifications.append(event)
+
+def worker(pipe, settings, reuse_port=True):
+	"""
+	This function is executed by each worker process.
+	Relays call it with a connection to the warserver as pipe.
+	"""
+	for name, value in settings.items():
+		setattr(connector, name, value)
+	connector.PACING_BUCKET = connector.TokenBucket(settings["MAX_PACKETS_PER_SECOND"],
+													settings["MAX_PACKETS_PER_SECOND"] / 10)
+	if "GLOBAL_HELLO_RATE" in settings:
+		connector.GLOBAL_HELLO_BUCKET = connector.TokenBucket(settings["GLOBAL_HELLO_RATE"],
+															  settings["GLOBAL_HELLO_BURST"])
+	if settings.get("CAPTURE_PATH"):
+		connector.start_capture(settings["CAPTURE_PATH"] + "." + str(os.getpid()))
+	proxy = EngineProxy(pipe)
+	connector.engine = proxy
+	threading.Thread(target=proxy.listen, daemon=True).start()
+	proxy.first_snapshot.wait()
+	connector.start_server(reuse_port=reuse_port)
+
+
+#Here follows the main process side
+
+class Remote:
+	"""
+	A worker or relay, as the main process sees it. process is None for relays.
+	Messages to it are queued and sent by a thread of its own,
+	so one that stops reading (e.g. a relay behind a stuck network) does not hold up the others.
+	"""
+
+	def __init__(self, process, pipe, tag):
+		self.process = process
+		self.pipe = pipe
+		self.tag = tag
+		self.queue = queue.Queue(MAX_QUEUED)
+		self.clients = collections.Counter()	#ip -> connections the engine counts for it, see client_connected
+		self.dropped = False
+		threading.Thread(target=self.send_queued, daemon=True).start()
+
+	def send(self, message):
+		"""queues a message. If MAX_QUEUED are queued already, the remote is dropped instead."""
+		if self.dropped:
+			return
+		try:
+			self.queue.put_nowait(message)
+		except queue.Full:
+			print("Artemis worker " + str(self.tag or self.process) + " fell behind, dropping it.")
+			self.drop()
+
+	def send_queued(self):
+		"""This function is executed by the sender thread of each remote."""
+		while not self.dropped:
+			message = self.queue.get()
+			if message is None:
+				return
+			try:
+				self.pipe.send(message)
+			except (OSError, ValueError) as exception:
+				print(exception)
+				self.drop()
+
+	def drop(self):
+		"""Ends the connection. serve_worker sees its end and releases the ships of the clients."""
+		if self.dropped:
+			return
+		self.dropped = True
+		if self.process is not None:
+			self.process.terminate()
+		else:
+			self.pipe.shutdown()
+
+	def close(self):
+		"""stops the sender thread, after serve_worker saw the end of the connection"""
+		self.drop()
+		try:
+			self.queue.put_nowait(None)
+		except queue.Full:
+			pass	#the sender thread stops after its next message, which fails
+
+def serve_worker(remote):
+	"""
+	This function is executed by one thread per worker.
+	It answers the calls of the worker with the engine.
+	The ips of the clients of a relay are prefixed with its tag, see add_worker.
+	When the worker stops or the relay disconnects, the engine forgets its connections,
+	so the ships of its clients are released.
+	"""
+	while True:
+		try:
+			message = remote.pipe.recv()
+		except (EOFError, OSError):
+			print("Artemis worker stopped.")
+			with PUBLISH_LOCK:
+				WORKERS[:] = [w for w in WORKERS if w is not remote]
+			remote.close()
+			for ip, connections in remote.clients.items():
+				for i in range(connections):
+					engine.client_disconnected((ip, None))
+			return
+		if message[0] == "stats":
+			_, number, stats = message
+			with STATS_ARRIVED:
+				if number in STATS_ANSWERS:	#else it came too late
+					STATS_ANSWERS[number].append((remote.tag, stats))
+					STATS_ARRIVED.notify_all()
+			continue
+		_, number, name, args = message
+		try:
+			if name not in CALLS:
+				raise AttributeError("engine function " + str(name) + " may not be called by workers")
+			if remote.tag and name in CLIENT_CALLS:
+				client = args[-1]
+				args = args[:-1] + ((remote.tag + client[0], client[1]),)
+			result = getattr(engine, name)(*args)
+			if name == "client_connected" and result:
+				remote.clients[args[-1][0]] += 1
+			elif name == "client_disconnected":
+				remote.clients[args[-1][0]] -= 1
+				if remote.clients[args[-1][0]] <= 0:
+					del remote.clients[args[-1][0]]
+			answer = ("result", number, True, result)
+		except Exception as exception:
+			answer = ("result", number, False, exception)
+		remote.send(answer)
+
+def compose_snapshot(published):
+	"""
+	Returns what the workers need for their broadcasts.
+	Sectors are only included, when their version differs from the one in published,
+	which is updated.
+	"""
+	versions = engine.get_versions()
+	sectors = dict()
+	for x in range(8):
+		for y in range(8):
+			if published[x][y] != versions["map"][x][y]:
+				sectors[(x, y)] = engine.get_sector(x, y)
+				published[x][y] = versions["map"][x][y]
+	return {
+		"game":		engine.get_game_version(),
+		"versions":	versions,
+		"sectors":	sectors,
+		"ships":	engine.get_ships(),
+		"turn":		engine.get_turn_status(),
+		"combat":	engine.get_combat_clients(),
+	}
+
+def for_worker(snapshot, tag):
+	"""Returns the snapshot with the combat clients of that worker only, with the ips it knows them by"""
+	if tag:
+		combat = {ip[len(tag):] for ip in snapshot["combat"] if ip.startswith(tag)}
+	else:
+		combat = {ip for ip in snapshot["combat"] if "/" not in ip}
+	return dict(snapshot, combat=combat)
+
+def publish(event):
+	"""
+	This function is executed by the publisher thread.
+	Whenever the game changes (and every TURN_REFRESH seconds for the turn time)
+	it sends the new parts of the game state to all workers.
+	"""
+	while True:
+		event.wait(timeout=TURN_REFRESH)
+		delay = event.remaining()
+		while delay > 0:
+			time.sleep(delay)
+			delay = event.remaining()
+		event.collect()
+		with PUBLISH_LOCK:
+			snapshot = compose_snapshot(PUBLISHED)
+			for remote in WORKERS:
+				remote.send(("snapshot", for_worker(snapshot, remote.tag)))
+
+def add_worker(process, pipe, tag=None):
+	"""
+	Serves a new worker (or relay) connected by pipe.
+	It gets the whole game state first and then the same snapshots as all others.
+	The engine knows ships by ip, but consoles behind different relays may share their LAN address.
+	So relays are given a tag like "host:port/", which is prepended to the ips of their clients.
+	"""
+	remote = Remote(process, pipe, tag)
+	with PUBLISH_LOCK:
+		snapshot = compose_snapshot([[None]*8 for x in range(8)])
+		remote.send(("snapshot", for_worker(snapshot, tag)))
+		WORKERS.append(remote)
+	threading.Thread(target=serve_worker, args=(remote,), daemon=True).start()
+
+def collect_stats(name):
+	"""
+	Asks all workers and relays for the connector stats name (see STATS).
+	Returns (tag, stats) of each one that answered within STATS_TIMEOUT, and how many were asked.
+	"""
+	number = next(STATS_NUMBERS)
+	with STATS_ARRIVED:
+		STATS_ANSWERS[number] = []
+	with PUBLISH_LOCK:
+		remotes = list(WORKERS)
+		for remote in remotes:
+			remote.send(("stats", number, name))
+	deadline = time.monotonic() + STATS_TIMEOUT
+	with STATS_ARRIVED:
+		while len(STATS_ANSWERS[number]) < len(remotes) and time.monotonic() < deadline:
+			STATS_ARRIVED.wait(deadline - time.monotonic())
+		return STATS_ANSWERS.pop(number), len(remotes)
+
+def add_counts(total, stats):
+	"""adds the integer counts of stats to total, also in nested dicts. Other values are kept as they are in total."""
+	for key, value in stats.items():
+		if isinstance(value, dict):
+			add_counts(total.setdefault(key, dict()), value)
+		elif isinstance(value, int) and not isinstance(value, bool) and isinstance(total.get(key, 0), int):
+			total[key] = total.get(key, 0) + value
+		else:
+			total.setdefault(key, value)
+
+def get_network_stats():
+	"""
+	Returns the telemetry of the connections of this process and of all workers and relays,
+	see connector.get_network_stats. The clients of relays carry the tag of their relay, like in the engine.
+	"""
+	stats = connector.get_network_stats()
+	answers, _ = collect_stats("network")
+	for tag, worker_stats in answers:
+		for address, telemetry in worker_stats.items():
+			if tag:
+				telemetry["ip"] = tag + telemetry["ip"]
+			stats[(tag or "") + address] = telemetry
+	return stats
+
+def get_counted_stats(name):
+	"""
+	Returns the connector stats name (see STATS) of this process added up with those of all workers and relays.
+	If there are any, "workers" says how many were asked and how many answered in time.
+	"""
+	stats = STATS[name]()
+	answers, asked = collect_stats(name)
+	for tag, worker_stats in answers:
+		add_counts(stats, worker_stats)
+	if asked:
+		stats["workers"] = {"asked": asked, "answered": len(answers)}
+	return stats
+
+def get_connection_stats():
+	"""see connector.get_connection_stats, of this process and all workers and relays"""
+	return get_counted_stats("connections")
+
+def get_notify_stats():
+	"""see connector.get_notify_stats, of this process and all workers and relays"""
+	return get_counted_stats("notify")
+
+def start_publisher():
+	"""starts the publisher thread, once"""
+	global PUBLISHER
+	with PUBLISH_LOCK:
+		if PUBLISHER is not None:
+			return
+		PUBLISHER = connector.CoalescingEvent()
+	engine.register_notification(PUBLISHER)
+	threading.Thread(target=publish, args=(PUBLISHER,), daemon=True).start()
+
+def start_server(workers):
+	"""starts the worker processes and the threads that serve them"""
+	if not hasattr(sockets, "SO_REUSEPORT"):
+		raise RuntimeError("SO_REUSEPORT is not available on this platform. Start without --workers.")
+	settings = {name: getattr(connector, name) for name in SETTINGS}
+	#the budget of paced sends is shared by the workers
+	settings["MAX_PACKETS_PER_SECOND"] = max(1, connector.MAX_PACKETS_PER_SECOND // workers)
+	#the connections are not split, because the kernel may spread the clients unevenly;
+	#each worker may take them all, and the engine refuses those above the total (see client_connected)
+	engine.MAX_CONNECTIONS = connector.MAX_CONNECTIONS
+	settings["CAPTURE_PATH"] = CAPTURE_PATH
+	settings["GLOBAL_HELLO_RATE"] = connector.GLOBAL_HELLO_RATE / workers
+	settings["GLOBAL_HELLO_BURST"] = max(1, connector.GLOBAL_HELLO_BURST / workers)
+	context = multiprocessing.get_context("spawn")	#do not fork the threads of this process
+	for i in range(workers):
+		pipe, worker_pipe = context.Pipe()
+		process = context.Process(target=worker, args=(worker_pipe, settings), daemon=True)
+		process.start()
+		add_worker(process, pipe)
+	start_publisher()
+	print("Started " + str(workers) + " Artemis worker processes.")
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+"""This is the capture module.
+A Recorder appends the datagrams the artemis connector receives and sends to a capture file,
+to replay them later (see tools/replay.py) or to benchmark with real traffic.
+The connector thread only copies the datagram into a list, a writer thread writes them.
+If the writer falls behind by MAX_PENDING_BYTES, further datagrams are dropped and counted.
+
+A capture file starts with MAGIC, followed by one record per datagram:
+RECORD_STRUCT (time, direction, ipv4 address, port, length) and the datagram itself.
+"""
+
+import socket
+import struct
+import threading
+import time
+
+__author__ = "Pithlit"
+__version__	= 1.0
+
+MAGIC = b"WARCAP1\n"
+RECORD_STRUCT = struct.Struct("<dB4sHH")	#time.time(), direction, ip, port, length
+INBOUND = 0
+OUTBOUND = 1
+MAX_PENDING_BYTES = 8 * 1024 * 1024
+WRITE_INTERVAL = 0.1	#seconds
+
+
+class Recorder:
+	"""Appends datagrams to a capture file from a writer thread."""
+
+	def __init__(self, path):
+		self.file = open(path, "ab")
+		if self.file.tell() == 0:
+			self.file.write(MAGIC)
+		self.lock = threading.Lock()
+		self.pending = []
+		self.pending_bytes = 0
+		self.recorded = 0
+		self.dropped = 0
+		self.addresses = dict()		#ip -> packed ip
+		self.running = True
+		self.thread = threading.Thread(target=self.write, daemon=True)
+		self.thread.start()
+
+	def record(self, direction, client, data):
+		"""Called for every datagram. data may be a reused buffer, so it is copied."""
+		size = len(data)
+		with self.lock:
+			if self.pending_bytes + size > MAX_PENDING_BYTES:
+				self.dropped += 1
+				return
+			self.pending.append((time.time(), direction, client, bytes(data)))
+			self.pending_bytes += size
+
+	def write(self):
+		"""This function is executed by the writer thread."""
+		while self.running:
+			time.sleep(WRITE_INTERVAL)
+			self.write_pending()
+
+	def write_pending(self):
+		with self.lock:
+			pending = self.pending
+			self.pending = []
+			self.pending_bytes = 0
+		if not pending:
+			return
+		records = []
+		for timestamp, direction, (ip, port), data in pending:
+			address = self.addresses.get(ip)
+			if address is None:
+				address = self.addresses[ip] = socket.inet_aton(ip)
+			records.append(RECORD_STRUCT.pack(timestamp, direction, address, port, len(data)))
+			records.append(data)
+		self.file.write(b"".join(records))
+		self.file.flush()
+		self.recorded += len(pending)
+
+	def close(self):
+		"""writes what is pending and closes the file"""
+		self.running = False
+		self.thread.join()
+		self.write_pending()
+		self.file.close()
+
+	def get_stats(self):
+		with self.lock:
+			return {
+				"recorded":	self.recorded,
+				"pending":	len(self.pending),
+				"dropped":	self.dropped,
+			}
+
+def read_capture(path):
+	"""Yields (time, direction, (ip, port), datagram) of each record in a capture file"""
+	with open(path, "rb") as capture:
+		if capture.read(len(MAGIC)) != MAGIC:
+			raise ValueError(path + " is no capture file")
+		while True:
+			header = capture.read(RECORD_STRUCT.size)
+			if len(header) < RECORD_STRUCT.size:
+				return	#end of file, or the last record was cut off
+			timestamp, direction, address, port, length = RECORD_STRUCT.unpack(header)
+			data = capture.read(length)
+			if len(data) < length:
+				return
+			yield timestamp, direction, (socket.inet_ntoa(address), port), data
@@ -8,11 +8,14 @@ If you are used to an object-orientaded programming paradigm, you can see those
 __author__ = "Pithlit"
 __version__ = 1.2
 
+import collections
 import random
 import copy
 import time
 from core.game_state import game
 from core.game_state import updated 
+from core.game_state import get_version
+from core import turn_timing
 
 ## game state structure needed by this module:
 # game
@@ -66,6 +69,9 @@ from core.game_state import updated
 #		-clients_move_through_sectors_with_other_clients
 #	-_notifications(list)
 
+CONNECTED = collections.Counter()	#ip -> connections of all artemis connectors, see client_connected
+MAX_CONNECTIONS = None	#of all artemis connectors together, None for no limit
+
 def log(msg):
 	print(time.asctime() + " Artemis Client " + msg)
 
@@ -86,12 +92,43 @@ def get_map():
 				rv[x].append(copy.deepcopy(sector))
 	return rv
 
+def get_sector(x, y):
+	"""Returns one sector of the map"""
+	with game._lock:
+		return copy.deepcopy(game.map[x][y])
+
+def get_game_version():
+	"""Returns a version that increases whenever anything in the game state changes"""
+	return get_version()
+
+def get_versions():
+	"""
+	Returns the versions of all map sectors, of the ships and of the turn.
+	A version increases whenever that part of the game state changes,
+	so callers can cache whatever they derive from it.
+	"""
+	with game._lock:
+		return {
+			"map":		[[get_version("map", x, y) for y in range(8)] for x in range(8)],
+			"ships":	get_version("artemis_clients"),
+			"turn":		get_version("turn"),
+		}
+
+def get_combat_clients():
+	"""
+	Returns the IPs of the Artemis clients that are inside a sector.
+	Those are in the simulation and do not show the map.
+	"""
+	with game._lock:
+		return {client for client, c in game.artemis_clients.items() if c.in_combat}
+
 def get_turn_status():
 	"Returns the turn dict with the seconds remaining as float"
 	with game._lock:
 		c = game._countdown
 		turn = copy.deepcopy(game.turn)
 		turn["remaining"] = max(c.get_remaining(), 0)
+		turn["transition_started"] = turn_timing.get_started()
 		return turn
 
 def get_ships():
@@ -281,11 +318,53 @@ def clear_sector(shipname, id, client):
 		updated("admiral")
 	log(shipname + " cleared " + str(sector.coordinates))
 
-def disconnect_client(self, client):
+def disconnect_client(client):
 	"""When a client disconects, free the sector"""
 	client = client[0]
 	_release_ship(client)
 
+def client_connected(client):
+	"""
+	An artemis connector registered a new connection of client.
+	Connections are counted by ip over all connectors and their worker processes,
+	because the ship belongs to the ip, see client_disconnected.
+	Returns False, if MAX_CONNECTIONS are counted already. Then the connection must be refused.
+	"""
+	with game._lock:
+		if MAX_CONNECTIONS is not None and sum(CONNECTED.values()) >= MAX_CONNECTIONS:
+			return False
+		CONNECTED[client[0]] += 1
+	return True
+
+def client_disconnected(client):
+	"""
+	A connection of client was closed, or its session was not resumed in time.
+	The ship is only released with the last connection from that ip,
+	another one may be flying it through another connector.
+	"""
+	client = client[0]
+	with game._lock:
+		CONNECTED[client] -= 1
+		if CONNECTED[client] > 0:
+			return
+		del CONNECTED[client]
+		_release_ship(client)
+
+def turn_over_sent(started, sent, clients):
+	"""
+	This is called after the artemis connector sent Data-Turn-Over to all its clients.
+	started is the transition_started of the turn status, sent the wall clock time.
+	"""
+	turn_timing.turn_over_sent(started, sent, clients)
+
+def batch():
+	"""
+	Returns the lock of the game state.
+	Callers that handle several requests at once hold it for all of them,
+	so the functions of this module do not acquire it over and over.
+	"""
+	return game._lock
+
 def register_notification(event):
 	"""
 	The caller gives to the engine, which is set when the map changes.
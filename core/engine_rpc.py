@@ -1,6 +1,8 @@
 
 from core.game_state import game
 from core import game_state as engine
+from core import artemis_sharding
+from core import turn_timing
 import core.engine_turns
 import copy
 from box import Box
@@ -14,6 +16,10 @@ import json
 #	-admiral
 #		-strategy_points
 
+def _path(items):
+	"""converts a split path to the path used by updated"""
+	return [int(item) if item.isdigit() else item for item in items]
+
 class rpc:
 
 	def __init__(self):
@@ -51,6 +57,7 @@ class rpc:
 			raise TypeError(value)
 		with game._lock:
 			target[items[-1]] = value
+			engine.updated(*_path(items))
 		return True
 			
 	def modify(self, path, value):
@@ -75,6 +82,7 @@ class rpc:
 			raise AttributeError
 		with game._lock:
 			target[items[-1]] += value
+			engine.updated(*_path(items))
 		return True
 
 	def place_base(self,x,y,base_value):
@@ -95,6 +103,8 @@ class rpc:
 				return False
 			game.admiral.strategy_points -= base_value
 			game.map[x][y][base_type] += 1
+			engine.updated("admiral")
+			engine.updated("map", x, y)
 		return True
 
 	def end_turn(self):
@@ -104,6 +114,19 @@ class rpc:
 		assert type(seconds) is int, "seconds must be int"
 		with game._lock:
 			game._countdown.inc(seconds)
+			engine.updated("turn")
 
 	def save_game(self, filename):
 		engine.save_game(filename)
+
+	def get_notify_stats(self):
+		return artemis_sharding.get_notify_stats()
+
+	def get_network_stats(self):
+		return artemis_sharding.get_network_stats()
+
+	def get_connection_stats(self):
+		return artemis_sharding.get_connection_stats()
+
+	def get_turn_timing(self):
+		return turn_timing.get_stats()
@@ -12,6 +12,7 @@ from core.game_state import updated
 from core.game_state import save_game 
 from core.countdown import countdown
 from core import engine_artemis
+from core import turn_timing
 
 
 ## game state structure needed by this module:
@@ -82,12 +83,18 @@ def start_default_game():
 	enemies_spawn()
 	defeat_bases()
 	enemies_proceed()
+	updated("map")
 	updated("turn")
 	
 
 def proceed_turn(*args, **kwargs):
-	"""proceeds to the next turn"""
+	"""
+	proceeds to the next turn.
+	The phases are timed and logged, see turn_timing.
+	"""
+	timing = turn_timing.Transition()
 	with game._lock:
+		timing.phase("lock")
 		game._countdown.cancel()	#ignored if this is executed by the timer_thread itself
 		turn = game.turn
 		logmsg = None
@@ -96,14 +103,20 @@ def proceed_turn(*args, **kwargs):
 				#turn_number starts with 1, interlude 1 comes after turn 1.
 				turn["interlude"] = False
 				zip_logs(turn.turn_number-1)
+				timing.phase("zip_logs")
 				game._countdown = countdown(game.rules.seconds_per_turn, proceed_turn)
 				logmsg = str(turn.turn_number)
 		else:
 			defeat_bases()
+			timing.phase("defeat_bases")
 			enemies_proceed()
+			timing.phase("enemies_proceed")
 			enemies_spawn()
+			timing.phase("enemies_spawn")
 			engine_artemis.release_all_ships()
+			timing.phase("release_all_ships")
 			zip_logs(turn.turn_number)
+			timing.phase("zip_logs")
 			turn.turn_number += 1
 			if not game.rules.allow_interludes:
 				game._countdown = countdown(game.rules.seconds_per_turn, proceed_turn)
@@ -111,15 +124,21 @@ def proceed_turn(*args, **kwargs):
 				turn.interlude = True
 				game._countdown = countdown(game.rules.seconds_per_interlude, proceed_turn)
 			save_game("_autosave_"+time.strftime("%Y-%m-%d-%H-%M-%S", time.localtime())+"_turn_"+str(turn["turn_number"])+".sav")
+			timing.phase("save_game")
 
 			logmsg = "interlude"
+			updated("map")
 		updated("turn")
+		timing.phase("notify")
 
 		total_enemies = 0
 		for column in game.map.values():	
 			for sector in column.values():
 				total_enemies += sector["enemies"]
+		if logmsg:
+			timing.finish(logmsg)	#before the turn status is read again
 	if logmsg:
+		timing.report()
 		log(logmsg + " started; Total Invaders: " + str(total_enemies))
 
 
@@ -96,13 +96,36 @@ def init_sector(**kwargs):
 #		-enemies_dont_go_direction == [ none | north | south | west | east ]
 #	-_notifications(list)
 
+VERSION = 0				#counts the calls of updated
+CHANGED = dict()		#path -> VERSION when exactly that path was updated
+CHANGED_BELOW = dict()	#path -> VERSION when that path or anything below it was updated
+
 def updated(*args):
-	"""something (given in args) has changed. Notifications are sent"""
-	#TODO args should be used
+	"""
+	something (given in args) has changed. Notifications are sent
+	args is the path of the change, e.g. updated("map", x, y).
+	Without args, everything counts as changed.
+	"""
+	global VERSION
 	with game._lock:
+		VERSION += 1
+		CHANGED[args] = VERSION
+		for i in range(len(args)+1):
+			CHANGED_BELOW[args[:i]] = VERSION
 		for event in game._notifications:
 			event.set()
 
+def get_version(*path):
+	"""
+	Returns the version of the last update of path, of something below path or of a parent of path.
+	The version increases whenever the item at path may have changed.
+	"""
+	with game._lock:
+		version = CHANGED_BELOW.get(path, 0)
+		for i in range(len(path)):
+			version = max(version, CHANGED.get(path[:i], 0))
+		return version
+
 def get_game_state_as_json():
 	game_state_dict = dict()
 	game_state_json = "{"
@@ -115,7 +138,7 @@ def get_game_state_as_json():
 				if isinstance(value, Box):
 					if key == "turn":
 						value = copy.deepcopy(value.to_dict())
-						value["remaining"] = game.countdown.get_remaining()
+						value["remaining"] = game._countdown.get_remaining()
 						game_state_dict[key] = value
 					else:
 						game_state_json += '"'+ key +'": ' + value.to_json() + ', '
@@ -136,7 +159,7 @@ def get_item_as_json(path):
 			break
 		if item == "turn":
 			value = copy.deepcopy(target.to_dict())
-			value["remaining"] = game.countdown.get_remaining()
+			value["remaining"] = game._countdown.get_remaining()
 			target = value
 	try:
 		retval = target.to_json()
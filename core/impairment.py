@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+"""This is the impairment module.
+An ImpairedSocket sits between a sender and its real socket (or asyncio transport)
+and makes the network worse on purpose: it drops, duplicates, delays and reorders
+the datagrams it sends, and caps the bandwidth to each destination.
+The artemis connector uses one with start_warserver.py --impair,
+the load generator with tools/loadgen.py --impair, so both directions can be impaired.
+
+Impairments are given as "name=value,..." strings, see parse and PARAMETERS.
+"""
+
+import heapq
+import itertools
+import random
+import threading
+import time
+
+__author__ = "Pithlit"
+__version__	= 1.0
+
+PARAMETERS = {
+	"loss":			0.0,	#probability that a datagram is dropped
+	"duplicate":	0.0,	#probability that a datagram is sent twice
+	"reorder":		0.0,	#probability that a datagram is held back behind later ones
+	"latency":		0.0,	#ms every datagram is delayed
+	"jitter":		0.0,	#ms the delay varies by, up and down
+	"bandwidth":	0.0,	#bytes per second to each destination, 0 for no limit
+	"queue":		1000.0,	#ms a datagram may wait for bandwidth before it is dropped
+}
+
+
+def parse(spec):
+	"""Returns the parameters of a string like "loss=0.05,jitter=200" """
+	parameters = dict(PARAMETERS)
+	for part in spec.split(","):
+		if not part.strip():
+			continue
+		name, _, value = part.partition("=")
+		name = name.strip()
+		if name not in PARAMETERS:
+			raise ValueError("unknown impairment " + name + ", choose from " + ", ".join(PARAMETERS))
+		parameters[name] = float(value)
+	return parameters
+
+
+class ImpairedSocket:
+	"""
+	Wraps a socket or asyncio transport. sendto and sendmsg are impaired,
+	everything else is passed to the wrapped object.
+	Delayed datagrams are sent by a thread of their own, or by the event loop if one is given.
+	"""
+
+	def __init__(self, inner, parameters, loop=None, seed=None):
+		self.inner = inner
+		self.parameters = parameters
+		self.clients = dict()		#ip -> parameters of that client, instead of the default ones
+		self.loop = loop
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.queue = []				#heap of (due, sequence, data, address)
+		self.sequence = itertools.count()
+		self.next_free = dict()		#address -> time.monotonic() when its bandwidth is free again
+		self.wakeup = threading.Condition(self.lock)
+		self.stats = {"sent": 0, "lost": 0, "duplicated": 0, "reordered": 0, "delayed": 0, "overflow": 0}
+		if loop is None:
+			threading.Thread(target=self.deliver, daemon=True).start()
+
+	def __getattr__(self, name):
+		return getattr(self.inner, name)
+
+	def set_client(self, ip, parameters):
+		"""impairs the datagrams to ip with other parameters than the default ones"""
+		self.clients[ip] = parameters
+
+	def sendmsg(self, buffers, ancdata=(), flags=0, address=None):
+		self.sendto(b"".join(buffers), address)
+
+	def sendto(self, data, address=None):
+		"""may be called by several threads at once"""
+		parameters = self.clients.get(address[0] if address else None, self.parameters)
+		now = time.monotonic()
+		with self.lock:
+			if self.random.random() < parameters["loss"]:
+				self.stats["lost"] += 1
+				return
+			copies = 1
+			if self.random.random() < parameters["duplicate"]:
+				copies = 2
+				self.stats["duplicated"] += 1
+			dues = []
+			for copy in range(copies):
+				delay = parameters["latency"] + self.random.uniform(-parameters["jitter"], parameters["jitter"])
+				if self.random.random() < parameters["reorder"]:
+					delay += parameters["latency"] + parameters["jitter"] + 10	#behind the next ones
+					self.stats["reordered"] += 1
+				due = now + max(delay, 0) / 1000
+				if parameters["bandwidth"]:
+					start = max(due, self.next_free.get(address, now))
+					if start - due > parameters["queue"] / 1000:
+						self.stats["overflow"] += 1
+						continue
+					self.next_free[address] = start + len(data) / parameters["bandwidth"]
+					due = start
+				dues.append(due)
+			if dues:
+				data = bytes(data)	#buffers of the caller may be reused
+			for due in dues:
+				if due > now:
+					self.stats["delayed"] += 1
+					if self.loop is None:
+						heapq.heappush(self.queue, (due, next(self.sequence), data, address))
+						self.wakeup.notify()
+		for due in dues:
+			if due <= now:
+				self.send_now(data, address)
+			elif self.loop is not None:
+				self.loop.call_later(due - now, self.send_now, data, address)
+
+	def send_now(self, data, address):
+		with self.lock:
+			self.stats["sent"] += 1
+		if address is None:
+			self.inner.sendto(data)	#connected asyncio transport
+		else:
+			self.inner.sendto(data, address)
+
+	def deliver(self):
+		"""This function is executed by the delivery thread."""
+		while True:
+			with self.wakeup:
+				while not self.queue or self.queue[0][0] > time.monotonic():
+					self.wakeup.wait(timeout=self.queue[0][0] - time.monotonic() if self.queue else None)
+				due, _, data, address = heapq.heappop(self.queue)
+			try:
+				self.send_now(data, address)
+			except OSError as exception:
+				print(exception)
+
+	def get_stats(self):
+		with self.lock:
+			return dict(self.stats)
@@ -57,6 +57,18 @@ class pyro_rpc(rpc):
 		print("save_game")
 		return rpc.save_game(self, filename)
 
+	def get_notify_stats(self):
+		return rpc.get_notify_stats(self)
+
+	def get_network_stats(self):
+		return rpc.get_network_stats(self)
+
+	def get_connection_stats(self):
+		return rpc.get_connection_stats(self)
+
+	def get_turn_timing(self):
+		return rpc.get_turn_timing(self)
+
 def get_ip():
 	"""* 
 	* Does NOT need routable net access or any connection at all. * Works
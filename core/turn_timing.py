@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+
+"""This is the turn timing module.
+It measures how long the crews are frozen at a turn boundary:
+engine_turns.proceed_turn times each of its phases with a Transition,
+the artemis connector reports when the last client was sent its Data-Turn-Over (see turn_over_sent).
+The durations are counted in histograms with the upper bounds BOUNDS, see get_stats.
+
+Transitions are told apart by the wall clock time they started,
+so workers in other processes (see artemis_sharding) can report their sends, too.
+"""
+
+import collections
+import threading
+import time
+
+__author__ = "Pithlit"
+__version__	= 1.0
+
+BOUNDS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)	#seconds; the last bucket counts everything above
+HISTORY = 20	#transitions kept for get_stats
+
+LOCK = threading.Lock()
+TRANSITIONS = collections.deque(maxlen=HISTORY)
+HISTOGRAMS = {
+	"proceed_turn":		[0] * (len(BOUNDS) + 1),	#from the end of the turn until the new one is set up
+	"turn_over_sent":	[0] * (len(BOUNDS) + 1),	#from the end of the turn until the last client was sent Data-Turn-Over
+}
+PENDING = None	#the last transition, until its turn over sends are counted
+
+
+def log(msg):
+	print(time.asctime() + " Turn " + str(msg))
+
+def count(histogram, seconds):
+	"""counts seconds in the bucket of the histogram it belongs to"""
+	for i, bound in enumerate(BOUNDS):
+		if seconds <= bound:
+			break
+	else:
+		i = len(BOUNDS)
+	HISTOGRAMS[histogram][i] += 1
+
+class Transition:
+	"""
+	The timing of one turn transition.
+	Call phase after each phase and finish at the end, while the game is still locked.
+	"""
+
+	def __init__(self):
+		self.started = time.time()		#wall clock, the same in all processes
+		self.mark = time.perf_counter()
+		self.start = self.mark
+		self.phases = dict()		#name -> seconds
+		self.turn = None
+		self.duration = None
+		self.turn_over_sent = None	#seconds after started
+		self.clients = 0
+
+	def phase(self, name):
+		"""the phase name just ended"""
+		now = time.perf_counter()
+		self.phases[name] = now - self.mark
+		self.mark = now
+
+	def finish(self, turn):
+		"""the transition to turn (a number or "interlude") is done"""
+		global PENDING
+		self.turn = turn
+		self.duration = time.perf_counter() - self.start
+		with LOCK:
+			if PENDING is not None and PENDING.turn_over_sent is not None:
+				count("turn_over_sent", PENDING.turn_over_sent)
+			PENDING = self
+			count("proceed_turn", self.duration)
+			TRANSITIONS.append(self)
+
+	def report(self):
+		"""logs the phases"""
+		log("transition to " + str(self.turn) + " took " + format_ms(self.duration) + ": "
+			+ ", ".join(name + " " + format_ms(seconds) for name, seconds in self.phases.items()))
+
+	def as_dict(self):
+		return {
+			"turn":		self.turn,
+			"started":	self.started,
+			"duration":	self.duration,
+			"phases":	dict(self.phases),
+			"turn_over_sent":	self.turn_over_sent,
+			"clients":	self.clients,
+		}
+
+def format_ms(seconds):
+	return "%.1f ms" % (seconds * 1000)
+
+def get_started():
+	"""Returns the wall clock time the last transition started, or None"""
+	pending = PENDING
+	return pending.started if pending is not None else None
+
+def turn_over_sent(started, sent, clients):
+	"""
+	The connector sent Data-Turn-Over to its last client at the wall clock time sent.
+	started is the value of get_started the turn status carried.
+	With several workers, the latest send counts.
+	"""
+	with LOCK:
+		pending = PENDING
+		if pending is None or pending.started != started:
+			return	#a transition that is counted already, or of another server
+		seconds = sent - started
+		if pending.turn_over_sent is None or seconds > pending.turn_over_sent:
+			pending.turn_over_sent = seconds
+		pending.clients += clients
+	log("over sent to " + str(clients) + " clients " + format_ms(seconds) + " after the turn ended")
+
+def get_stats():
+	"""
+	Returns the histograms as (upper bound, count) lists, the last bound is None,
+	and the last transitions with their phases.
+	The turn over sends of the last transition are only in the histogram after the next one.
+	"""
+	with LOCK:
+		return {
+			"histograms":	{name: list(zip(BOUNDS + (None,), counts)) for name, counts in HISTOGRAMS.items()},
+			"transitions":	[transition.as_dict() for transition in TRANSITIONS],
+		}
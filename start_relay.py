@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Starts a relay between Artemis clients and a warserver started with --relay_listen.
+With --self_test, starts a warserver and two relays on loopback and checks that
+Artemis requests get through both relays.
+"""
+import argparse
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import time
+from core import artemis_connector, artemis_relay, artemis_client
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def collect(sock, seconds):
+	"""Returns the (type, number, subtype) of all packages received in the next seconds"""
+	packages = []
+	deadline = time.monotonic() + seconds
+	while time.monotonic() < deadline:
+		sock.settimeout(max(deadline - time.monotonic(), 0.01))
+		try:
+			data, _ = sock.recvfrom(artemis_connector.MAX_INCOMING)
+		except socket.timeout:
+			break
+		packages.extend(artemis_client.read(data))
+	return packages
+
+def check(name, packages, package_type, subtype=None):
+	found = any(p[0] == package_type and (subtype is None or p[2] == subtype) for p in packages)
+	print(("ok      " if found else "FAILED  ") + name)
+	return found
+
+def self_test(port, authkey):
+	"""runs a warserver and two relays on loopback. Returns True, if both relays work."""
+	relay_address = "127.0.0.1:" + str(port + 1)
+	processes = [subprocess.Popen([sys.executable, "start_warserver.py", "--port", str(port),
+								   "--relay_listen", relay_address, "--relay_authkey", authkey], cwd=HERE)]
+	time.sleep(1)
+	for relay_port in (port + 2, port + 3):
+		processes.append(subprocess.Popen([sys.executable, "start_relay.py", "--central", relay_address,
+										   "--authkey", authkey, "--port", str(relay_port)], cwd=HERE))
+	time.sleep(3)
+	passed = True
+	try:
+		for number, relay_port in enumerate((port + 2, port + 3)):
+			sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			address = ("127.0.0.1", relay_port)
+			sock.sendto(artemis_client.compose_hello(), address)
+			packages = collect(sock, 2)
+			passed &= check("relay " + str(number) + ": hello answered", packages, "Server-hello")
+			passed &= check("relay " + str(number) + ": map received", packages, "Data", "Data-Map")
+			columns = [[] for x in range(8)]
+			for _, _, subtype, payload in packages:
+				if subtype == "Data-Map":
+					x, sectors = artemis_client.read_map_col(payload)
+					columns[x] = sectors
+			#the relay acks the enter itself, only the sector data comes from the warserver
+			packages = []
+			for package_number, (x, y) in enumerate(artemis_client.enterable(columns)[:3], 1):
+				sock.sendto(artemis_client.compose_enter(0, package_number, x, y, "Relay Test " + str(number)), address)
+				packages = collect(sock, 1)
+				if any(p[2] == "Data-Sector" for p in packages):
+					break
+			passed &= check("relay " + str(number) + ": enter answered", packages, "Data", "Data-Sector")
+			sock.sendto(artemis_client.compose_bye(0, 10), address)
+			sock.close()
+	finally:
+		for process in processes:
+			process.terminate()
+		for process in processes:
+			process.wait()
+	print("self test " + ("passed" if passed else "FAILED"))
+	return passed
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description='Starts a relay for Artemis clients in front of a WarServer.')
+	parser.add_argument('--central', type=str, default='127.0.0.1', metavar='HOST[:PORT]', help='the warserver, started with --relay_listen')
+	parser.add_argument('--authkey', type=str, help='the --relay_authkey of the warserver (the self test makes one up)')
+	parser.add_argument('--port', type=int, default=artemis_connector.PORT, help='the UDP port Artemis clients connect to')
+	parser.add_argument('--no_packing', action='store_true', help='send each data package to Artemis clients in a datagram of its own')
+	parser.add_argument('--pacing_window', type=float, default=artemis_connector.PACING_WINDOW, metavar='SECONDS', help='spread the sends of each broadcast over this many seconds (0: send at once)')
+	parser.add_argument('--max_packets_per_second', type=int, default=artemis_connector.MAX_PACKETS_PER_SECOND, help='limits the paced sends of broadcasts')
+	parser.add_argument('--keyframe_interval', type=float, default=artemis_connector.KEYFRAME_INTERVAL, metavar='SECONDS', help='send the whole map to each Artemis client this often')
+	parser.add_argument('--connection_timeout', type=float, default=artemis_connector.CONNECTION_TIMEOUT, metavar='SECONDS', help='disconnect Artemis clients that sent nothing for this long')
+	parser.add_argument('--self_test', action='store_true', help='run a warserver and two relays on loopback and check them')
+	parser.add_argument('--self_test_port', type=int, default=3100, help='first of the four ports the self test uses')
+	args = parser.parse_args()
+
+	if args.self_test:
+		sys.exit(0 if self_test(args.self_test_port, args.authkey or secrets.token_hex(16)) else 1)
+	if not args.authkey:
+		parser.error("the --authkey is needed, it is the --relay_authkey of the warserver")
+
+	settings = {
+		"PORT":					args.port,
+		"PACK_DATA":			not args.no_packing,
+		"PACING_WINDOW":		args.pacing_window,
+		"MAX_PACKETS_PER_SECOND":	args.max_packets_per_second,
+		"KEYFRAME_INTERVAL":	args.keyframe_interval,
+		"CONNECTION_TIMEOUT":	args.connection_timeout,
+	}
+	artemis_relay.start_relay(artemis_relay.parse_address(args.central), bytes(args.authkey, "utf-8"), settings)
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 import argparse
-from core import game_state, engine_turns, engine_artemis, engine_rpc, artemis_connector 
+from core import game_state, engine_turns, engine_artemis, engine_rpc, artemis_connector, artemis_asyncio, artemis_sharding, artemis_relay, impairment
 try:
 	from core import pyro_connector
 	PYRO = True
@@ -13,7 +13,31 @@ if __name__ == "__main__":
 	parser.add_argument('--load', '-l', type=open, metavar='FILE', help='Load saved game or scenario from file') 
 	#parser.add_argument('--headless', action='store_true', help='run without a gui')
 	parser.add_argument('--pyro_nameserver', type=str, help='connect to an existing pyto nameserver')
+	parser.add_argument('--asyncio', action='store_true', help='serve Artemis clients from one asyncio event loop')
+	parser.add_argument('--port', type=int, default=artemis_connector.PORT, help='the UDP port Artemis clients connect to')
+	parser.add_argument('--relay_listen', type=str, metavar='[HOST]:PORT', help='accept relays (see start_relay.py) on this TCP address')
+	parser.add_argument('--relay_authkey', type=str, help='relays must know this key, needed with --relay_listen')
+	parser.add_argument('--workers', type=int, default=0, metavar='N', help='serve Artemis clients from N processes that share the port (needs SO_REUSEPORT)')
+	parser.add_argument('--coalesce_window', type=float, default=artemis_connector.COALESCE_WINDOW, metavar='SECONDS', help='merge game state changes into one broadcast until there was none for this long')
+	parser.add_argument('--coalesce_max_latency', type=float, default=artemis_connector.COALESCE_MAX_LATENCY, metavar='SECONDS', help='but broadcast at most this long after the first change')
+	parser.add_argument('--no_packing', action='store_true', help='send each data package to Artemis clients in a datagram of its own')
+	parser.add_argument('--pacing_window', type=float, default=artemis_connector.PACING_WINDOW, metavar='SECONDS', help='spread the sends of each broadcast over this many seconds (0: send at once)')
+	parser.add_argument('--max_packets_per_second', type=int, default=artemis_connector.MAX_PACKETS_PER_SECOND, help='limits the paced sends of broadcasts')
+	parser.add_argument('--keyframe_interval', type=float, default=artemis_connector.KEYFRAME_INTERVAL, metavar='SECONDS', help='send the whole map to each Artemis client this often')
+	parser.add_argument('--broadcast_interval', type=float, default=artemis_connector.BROADCAST_INTERVAL, metavar='SECONDS', help='send updates to Artemis clients at least this often')
+	parser.add_argument('--idle_broadcast_interval', type=float, default=artemis_connector.IDLE_BROADCAST_INTERVAL, metavar='SECONDS', help='back off up to this interval while nothing changes')
+	parser.add_argument('--combat_status_interval', type=float, default=artemis_connector.COMBAT_STATUS_INTERVAL, metavar='SECONDS', help='send turn status and ships to Artemis clients inside a sector this often')
+	parser.add_argument('--connection_timeout', type=float, default=artemis_connector.CONNECTION_TIMEOUT, metavar='SECONDS', help='disconnect Artemis clients that sent nothing for this long')
+	parser.add_argument('--max_connections', type=int, default=artemis_connector.MAX_CONNECTIONS, help='refuse further Artemis clients')
+	parser.add_argument('--hello_rate', type=float, default=artemis_connector.HELLO_RATE, metavar='PER_SECOND', help='Client-hellos handled per address')
+	parser.add_argument('--global_hello_rate', type=float, default=artemis_connector.GLOBAL_HELLO_RATE, metavar='PER_SECOND', help='Client-hellos handled from all addresses')
+	parser.add_argument('--session_grace', type=float, default=artemis_connector.SESSION_GRACE, metavar='SECONDS', help='Artemis clients that lost their connection may resume it this long')
+	parser.add_argument('--capture', type=str, metavar='FILE', help='record all Artemis traffic to FILE, see tools/replay.py')
+	parser.add_argument('--impair', type=impairment.parse, metavar='NAME=VALUE,...', help='impair the traffic to Artemis clients on purpose: ' + ", ".join(impairment.PARAMETERS))
+	parser.add_argument('--impair_client', type=str, action='append', default=[], metavar='IP:NAME=VALUE,...', help='impair the traffic to one Artemis client (repeatable)')
 	args = parser.parse_args()
+	if args.relay_listen and not args.relay_authkey:
+		parser.error("--relay_listen needs a --relay_authkey")
 
 	print("starting warserver")
 	game = game_state.create_game(args.load)
@@ -23,7 +47,42 @@ if __name__ == "__main__":
 	else:
 		engine_turns.start_default_game()
 	#print(game)
-	artemis_connector.start_server()
+	artemis_connector.PORT = args.port
+	artemis_connector.KEYFRAME_INTERVAL = args.keyframe_interval
+	artemis_connector.CONNECTION_TIMEOUT = args.connection_timeout
+	artemis_connector.SESSION_GRACE = args.session_grace
+	artemis_connector.MAX_CONNECTIONS = args.max_connections
+	artemis_connector.HELLO_RATE = args.hello_rate
+	artemis_connector.GLOBAL_HELLO_RATE = args.global_hello_rate
+	artemis_connector.GLOBAL_HELLO_BURST = 2 * args.global_hello_rate
+	artemis_connector.GLOBAL_HELLO_BUCKET = artemis_connector.TokenBucket(args.global_hello_rate, 2 * args.global_hello_rate)
+	artemis_connector.BROADCAST_INTERVAL = args.broadcast_interval
+	artemis_connector.BROADCAST_TIMEOUT = args.broadcast_interval
+	artemis_connector.IDLE_BROADCAST_INTERVAL = args.idle_broadcast_interval
+	artemis_connector.COMBAT_STATUS_INTERVAL = args.combat_status_interval
+	artemis_connector.PACK_DATA = not args.no_packing
+	artemis_connector.PACING_WINDOW = args.pacing_window
+	artemis_connector.MAX_PACKETS_PER_SECOND = args.max_packets_per_second
+	artemis_connector.PACING_BUCKET = artemis_connector.TokenBucket(args.max_packets_per_second, args.max_packets_per_second / 10)
+	artemis_connector.COALESCE_WINDOW = args.coalesce_window
+	artemis_connector.COALESCE_MAX_LATENCY = args.coalesce_max_latency
+	artemis_connector.IMPAIRMENT = args.impair
+	for spec in args.impair_client:
+		ip, _, parameters = spec.partition(":")
+		artemis_connector.IMPAIRED_CLIENTS[ip] = impairment.parse(parameters)
+	if args.capture:
+		if args.workers:
+			artemis_sharding.CAPTURE_PATH = args.capture
+		else:
+			artemis_connector.start_capture(args.capture)
+	if args.workers:
+		artemis_sharding.start_server(args.workers)
+	elif args.asyncio:
+		artemis_asyncio.start_server()
+	else:
+		artemis_connector.start_server()
+	if args.relay_listen:
+		artemis_relay.listen(artemis_relay.parse_address(args.relay_listen), bytes(args.relay_authkey, "utf-8"))
 	if PYRO:
 		if args.pyro_nameserver:
 			pyro_connector.start_server(args.pyro_nameserver)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+Load generator for the warserver.
+Simulates Artemis Game Servers (ships) that speak the client side of the protocol:
+hello, heartbeats, heartbeat acks, Sector-Enter/Kill/Leave and bye.
+Each ship has its own UDP socket and, on Linux, its own loopback address,
+so the warserver sees them as different clients.
+Reports percentiles of the handshake latency, of the latency from Sector-Enter
+to Sector-Ack and to the sector data, of the broadcast fan-out delay
+(how much later than the first ship each ship got the same turn status)
+and of the packet loss per ship.
+With --impair and --server_impair, the traffic in either direction is impaired (see core/impairment.py),
+to measure how much redundant traffic the server and the ships send to make up for it.
+	call: python tools/loadgen.py [--ships N] [--duration SECONDS] [--mix idle:50,explorer:30,fighter:20] [--start_server]
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from core import artemis_client, impairment
+
+HELLO_RETRY = 1			#seconds; Artemis repeats its hello this often
+ENTER_TIMEOUT = 2		#seconds to wait for the sector data, before an enter counts as refused
+HEARTBEAT_INTERVAL = 0.5
+FANOUT_GAP = 0.05		#seconds between two broadcasts, at least
+
+#seconds between the actions of a ship, None for never
+PROFILES = {
+	"idle":		{"enter_every": None, "kill_every": None, "leave_after": None},	#sits on the map screen
+	"explorer":	{"enter_every": 5, "kill_every": None, "leave_after": None},	#tries to enter sectors
+	"fighter":	{"enter_every": 20, "kill_every": 3, "leave_after": 15},		#enters, kills and clears
+}
+
+
+class Stats:
+	"""collects the measurements of all ships"""
+
+	def __init__(self):
+		self.latencies = collections.defaultdict(list)	#name -> milliseconds
+		self.loss = collections.defaultdict(list)		#name -> ratio per ship
+		self.first_seen = dict()	#turn status payload -> time the first ship got it in the current broadcast
+		self.last_seen = dict()		#turn status payload -> time the last ship got it
+		self.counts = collections.Counter()
+
+	def latency(self, name, seconds):
+		self.latencies[name].append(seconds * 1000)
+
+	def broadcast(self, payload, now):
+		"""
+		A ship got a turn status. All ships get the same one in a broadcast, one after the other.
+		A pause of FANOUT_GAP seconds starts the next broadcast, even if the turn status is the same.
+		"""
+		last = self.last_seen.get(payload)
+		if last is None or now - last > FANOUT_GAP:
+			self.first_seen[payload] = now
+		self.last_seen[payload] = now
+		self.latency("broadcast fan-out", now - self.first_seen[payload])
+
+
+class Ship(asyncio.DatagramProtocol):
+	"""One simulated Artemis Game Server"""
+
+	def __init__(self, index, profile, stats, impaired=None):
+		self.index = index
+		self.name = "Load " + str(index)
+		self.profile = PROFILES[profile]
+		self.stats = stats
+		self.impaired = impaired	#impairment parameters of the sent datagrams
+		self.transport = None
+		self.connection_number = 0
+		self.hello_sent = None
+		self.connected = asyncio.Event()
+		self.sector_numbers = iter(range(1, 0x10000))
+		self.heartbeat_numbers = iter(range(1, 0x10000))
+		self.enters = dict()		#sector package number -> time sent
+		self.enter_pending = None	#time of the last enter without sector data yet
+		self.battle = None			#id of the sector data that answered the last enter
+		self.battle_arrived = asyncio.Event()
+		self.map = [[] for x in range(8)]	#the sectors of each column, as the warserver sent them
+		self.heartbeats = dict()	#heartbeat number -> time sent
+		self.heartbeats_acked = 0
+		self.last_data_number = None
+		self.data_received = 0
+		self.data_lost = 0
+		self.synced = False
+
+	def connection_made(self, transport):
+		if self.impaired is not None:
+			transport = impairment.ImpairedSocket(transport, self.impaired, asyncio.get_running_loop(), random.random())
+		self.transport = transport
+
+	def error_received(self, exception):
+		self.stats.counts["socket errors"] += 1
+
+	def datagram_received(self, data, address):
+		now = time.monotonic()
+		self.stats.counts["datagrams received"] += 1
+		self.stats.counts["bytes received"] += len(data)
+		connection_number, server_time = artemis_client.read_preamble(data)
+		for package_type, number, subtype, payload in artemis_client.read(data):
+			if package_type == "Server-hello":
+				if not self.connected.is_set():
+					self.connection_number = connection_number
+					self.stats.latency("handshake", now - self.hello_sent)
+					self.connected.set()
+			elif package_type == "Heartbeat":
+				self.send(artemis_client.compose_heartbeat_ack(self.connection_number, number, server_time or 0))
+			elif package_type == "Heartbeat-Ack":
+				sent = self.heartbeats.pop(number, None)
+				if sent is not None:
+					self.heartbeats_acked += 1
+					self.stats.latency("heartbeat round trip", now - sent)
+			elif package_type == "Sector-Ack":
+				sent = self.enters.pop(number, None)
+				if sent is not None:
+					self.stats.latency("enter to Sector-Ack", now - sent)
+			elif package_type == "Data":
+				self.count_data(number)
+				if subtype == "Data-Turn":
+					if self.synced:
+						self.stats.broadcast(payload, now)
+					self.synced = True	#the first one is the resync after the hello, not a broadcast
+				elif subtype == "Data-Sector" and self.enter_pending is not None:
+					self.stats.latency("enter to sector data", now - self.enter_pending)
+					self.enter_pending = None
+					self.battle = artemis_client.read_sector(payload)["id"]
+					self.battle_arrived.set()
+				elif subtype == "Data-Map" and self.profile["enter_every"] is not None:
+					x, sectors = artemis_client.read_map_col(payload)
+					self.map[x] = sectors
+				self.stats.counts[subtype] += 1
+
+	def count_data(self, number):
+		"""counts the data packages that did not arrive, by the gaps in their numbers"""
+		self.data_received += 1
+		if self.last_data_number is not None:
+			gap = (number - self.last_data_number) % 0x10000
+			if gap == 0 or gap >= 0x8000:
+				self.stats.counts["data duplicate or late"] += 1
+				return
+			self.data_lost += max(gap - 1, 0)
+		self.last_data_number = number
+
+	def send(self, data):
+		self.transport.sendto(data)
+		self.stats.counts["datagrams sent"] += 1
+		self.stats.counts["bytes sent"] += len(data)
+
+	async def handshake(self):
+		"""says hello until the server answers"""
+		self.hello_sent = time.monotonic()
+		while not self.connected.is_set():
+			self.send(artemis_client.compose_hello())
+			try:
+				await asyncio.wait_for(self.connected.wait(), HELLO_RETRY)
+			except asyncio.TimeoutError:
+				self.stats.counts["hello retries"] += 1
+
+	async def heartbeat(self):
+		while True:
+			number = next(self.heartbeat_numbers)
+			self.heartbeats[number] = time.monotonic()
+			self.send(artemis_client.compose_heartbeat(self.connection_number, number))
+			await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+	async def enter(self):
+		"""
+		Enters a sector the map allows. Returns the battle id of the sector data the warserver answers with,
+		or None if there is no such sector or the warserver refused.
+		"""
+		sectors = artemis_client.enterable(self.map)
+		if not sectors:
+			self.stats.counts["no sector to enter"] += 1
+			return None
+		x, y = random.choice(sectors)
+		number = next(self.sector_numbers)
+		self.battle = None
+		self.battle_arrived.clear()
+		self.enters[number] = self.enter_pending = time.monotonic()
+		self.send(artemis_client.compose_enter(self.connection_number, number, x, y, self.name))
+		self.stats.counts["enters"] += 1
+		try:
+			await asyncio.wait_for(self.battle_arrived.wait(), ENTER_TIMEOUT)
+		except asyncio.TimeoutError:
+			self.enter_pending = None
+			self.stats.counts["enters refused"] += 1
+			return None
+		return self.battle
+
+	async def behave(self):
+		"""does what the profile says, until cancelled"""
+		enter_every = self.profile["enter_every"]
+		if enter_every is None:
+			return
+		await asyncio.sleep(random.uniform(0, enter_every))
+		while True:
+			battle = await self.enter()
+			entered = time.monotonic()
+			kill_every = self.profile["kill_every"]
+			leave_after = self.profile["leave_after"]
+			if battle is None:
+				kill_every = leave_after = None	#kills and leaves need the id of the battle
+			while kill_every is not None and time.monotonic() - entered + kill_every < (leave_after or 0):
+				await asyncio.sleep(random.uniform(0.5, 1.5) * kill_every)
+				self.send(artemis_client.compose_kill(self.connection_number, next(self.sector_numbers),
+													  battle, random.randint(1, 3), self.name))
+				self.stats.counts["kills"] += 1
+			if leave_after is not None:
+				await asyncio.sleep(max(0, leave_after - (time.monotonic() - entered)))
+				self.send(artemis_client.compose_leave(self.connection_number, next(self.sector_numbers),
+													   battle, self.name))
+				self.stats.counts["leaves"] += 1
+			await asyncio.sleep(random.uniform(0.5, 1.5) * enter_every)
+
+	async def run(self, duration):
+		await self.handshake()
+		tasks = [asyncio.ensure_future(self.heartbeat()), asyncio.ensure_future(self.behave())]
+		await asyncio.sleep(duration)
+		for task in tasks:
+			task.cancel()
+		self.send(artemis_client.compose_bye(self.connection_number, next(self.heartbeat_numbers)))
+
+	def report_loss(self):
+		sent = len(self.heartbeats) + self.heartbeats_acked
+		if sent:
+			self.stats.loss["heartbeats unanswered"].append(len(self.heartbeats) / sent)
+		if self.data_received:
+			self.stats.loss["data packages"].append(self.data_lost / (self.data_received + self.data_lost))
+
+
+def local_address(index, distinct):
+	"""Returns a loopback address of its own for each ship, if distinct and the platform allows it."""
+	if not distinct:
+		return "127.0.0.1"
+	return "127.1." + str(index // 250) + "." + str(index % 250 + 1)
+
+def distinct_addresses_work():
+	"""Linux routes all of 127.0.0.0/8 to the loopback interface, other platforms do not"""
+	probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	try:
+		probe.bind((local_address(0, True), 0))
+		return True
+	except OSError:
+		return False
+	finally:
+		probe.close()
+
+def parse_mix(mix):
+	"""Returns [(profile, weight)] of "name:weight,name:weight" """
+	profiles = []
+	for part in mix.split(","):
+		name, _, weight = part.partition(":")
+		if name not in PROFILES:
+			raise argparse.ArgumentTypeError("unknown profile " + name + ", choose from " + ", ".join(PROFILES))
+		profiles.append((name, float(weight or 1)))
+	return profiles
+
+def percentiles(values):
+	"""Returns count, p50, p90, p99 and max of values"""
+	values = sorted(values)
+	if not values:
+		return {"count": 0}
+	def rank(p):
+		return values[min(len(values) - 1, int(p / 100 * len(values)))]
+	return {"count": len(values), "p50": rank(50), "p90": rank(90), "p99": rank(99), "max": values[-1]}
+
+async def run(args):
+	loop = asyncio.get_running_loop()
+	stats = Stats()
+	distinct = not args.same_address and distinct_addresses_work()
+	names, weights = zip(*args.mix)
+	ships = []
+	for index in range(args.ships):
+		ship = Ship(index, random.choices(names, weights)[0], stats, args.impair)
+		await loop.create_datagram_endpoint(lambda: ship, local_addr=(local_address(index, distinct), 0),
+											remote_addr=(args.host, args.port))
+		ships.append(ship)
+	runs = []
+	for ship in ships:
+		runs.append(asyncio.ensure_future(ship.run(args.duration)))
+		await asyncio.sleep(args.ramp / len(ships))
+	await asyncio.gather(*runs)
+	await asyncio.sleep(1)	#late answers
+	impaired = collections.Counter()
+	for ship in ships:
+		ship.report_loss()
+		if args.impair is not None:
+			impaired.update(ship.transport.get_stats())
+		ship.transport.close()
+	return {
+		"ships":		args.ships,
+		"distinct_addresses":	distinct,
+		"latency_ms":	{name: percentiles(values) for name, values in stats.latencies.items()},
+		"loss":			{name: percentiles(values) for name, values in stats.loss.items()},
+		"counts":		dict(stats.counts),
+		"impairment":	dict(impaired),
+	}
+
+def print_report(report):
+	print("%d ships, %s" % (report["ships"], "one address each" if report["distinct_addresses"] else "one address"))
+	print("%-24s %8s %10s %10s %10s %10s" % ("latency [ms]", "count", "p50", "p90", "p99", "max"))
+	for name, p in sorted(report["latency_ms"].items()):
+		if p["count"]:
+			print("%-24s %8d %10.2f %10.2f %10.2f %10.2f" % (name, p["count"], p["p50"], p["p90"], p["p99"], p["max"]))
+	print("%-24s %8s %10s %10s %10s %10s" % ("loss per ship", "ships", "p50", "p90", "p99", "max"))
+	for name, p in sorted(report["loss"].items()):
+		if p["count"]:
+			print("%-24s %8d %9.1f%% %9.1f%% %9.1f%% %9.1f%%" % (name, p["count"], 100*p["p50"], 100*p["p90"], 100*p["p99"], 100*p["max"]))
+	for name, count in sorted(report["counts"].items(), key=lambda item: str(item[0])):
+		print("%-24s %8d" % (name, count))
+	for name, count in sorted(report["impairment"].items()):
+		print("%-24s %8d" % ("impaired: " + name, count))
+
+def start_server(args):
+	"""starts a warserver on loopback that admits all ships at once"""
+	command = [sys.executable, "start_warserver.py", "--port", str(args.port),
+			   "--max_connections", str(args.ships + 16),
+			   "--hello_rate", "1000", "--global_hello_rate", "100000"]
+	if getattr(args, "server_impair", None):
+		command += ["--impair", args.server_impair]
+	server = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL if args.quiet_server else None)
+	time.sleep(args.server_startup)
+	return server
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Simulates Artemis clients against a warserver.')
+	parser.add_argument('--host', type=str, default='127.0.0.1', help='the warserver')
+	parser.add_argument('--port', type=int, default=3000)
+	parser.add_argument('--ships', type=int, default=100)
+	parser.add_argument('--duration', type=float, default=30, metavar='SECONDS', help='how long each ship stays connected')
+	parser.add_argument('--ramp', type=float, default=2, metavar='SECONDS', help='spread the hellos of all ships over this time')
+	parser.add_argument('--mix', type=parse_mix, default=parse_mix("idle:50,explorer:30,fighter:20"), metavar='PROFILE:WEIGHT,...',
+						help='share of the behaviour profiles: ' + ", ".join(PROFILES))
+	parser.add_argument('--same_address', action='store_true', help='send from 127.0.0.1 only')
+	parser.add_argument('--start_server', action='store_true', help='start a warserver on loopback for the run')
+	parser.add_argument('--server_startup', type=float, default=3, metavar='SECONDS')
+	parser.add_argument('--quiet_server', action='store_true', help='hide the output of the started warserver')
+	parser.add_argument('--impair', type=impairment.parse, metavar='NAME=VALUE,...', help='impair the datagrams the ships send: ' + ", ".join(impairment.PARAMETERS))
+	parser.add_argument('--server_impair', type=str, metavar='NAME=VALUE,...', help='impair the datagrams the started warserver sends')
+	parser.add_argument('--seed', type=int, help='for repeatable runs')
+	parser.add_argument('--json', action='store_true', help='print the report as json')
+	args = parser.parse_args()
+
+	random.seed(args.seed)
+	server = start_server(args) if args.start_server else None
+	try:
+		report = asyncio.run(run(args))
+	finally:
+		if server is not None:
+			server.terminate()
+			server.wait()
+	if args.json:
+		print(json.dumps(report, indent=2))
+	else:
+		print_report(report)
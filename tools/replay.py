@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Replays the inbound traffic of a capture file (see start_warserver.py --capture)
+against a warserver, with the original timing or accelerated.
+Each captured client gets a socket of its own, on Linux with its own loopback address.
+Reports how late the datagrams were sent against the schedule and what the server answered.
+	call: python tools/replay.py CAPTURE [--speed FACTOR] [--start_server]
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from core import artemis_client, capture
+from loadgen import local_address, distinct_addresses_work, percentiles, start_server
+
+
+class Client(asyncio.DatagramProtocol):
+	"""Sends the datagrams of one captured client and counts the answers"""
+
+	def __init__(self, answers):
+		self.answers = answers
+		self.transport = None
+
+	def connection_made(self, transport):
+		self.transport = transport
+
+	def datagram_received(self, data, address):
+		for package_type, number, subtype, payload in artemis_client.read(data):
+			self.answers[subtype or package_type] += 1
+
+async def replay(args, records):
+	loop = asyncio.get_running_loop()
+	distinct = not args.same_address and distinct_addresses_work()
+	answers = collections.Counter()
+	clients = dict()	#captured address -> Client
+	for _, _, address, _ in records:
+		if address not in clients:
+			clients[address] = Client(answers)
+			await loop.create_datagram_endpoint(lambda: clients[address],
+												local_addr=(local_address(len(clients) - 1, distinct), 0),
+												remote_addr=(args.host, args.port))
+	lateness = []
+	start = time.monotonic()
+	first = records[0][0]
+	for timestamp, _, address, data in records:
+		if args.speed > 0:
+			due = start + (timestamp - first) / args.speed
+			delay = due - time.monotonic()
+			if delay > 0:
+				await asyncio.sleep(delay)
+			lateness.append((time.monotonic() - due) * 1000)
+		clients[address].transport.sendto(data)
+	duration = time.monotonic() - start
+	await asyncio.sleep(1)	#late answers
+	for client in clients.values():
+		client.transport.close()
+	return {
+		"clients":		len(clients),
+		"distinct_addresses":	distinct,
+		"datagrams":	len(records),
+		"captured_seconds":	records[-1][0] - first,
+		"replayed_seconds":	duration,
+		"lateness_ms":	percentiles(lateness),
+		"answers":		dict(answers),
+	}
+
+def print_report(report):
+	print("%d datagrams of %d clients: %.1f seconds captured, replayed in %.1f seconds"
+		  % (report["datagrams"], report["clients"], report["captured_seconds"], report["replayed_seconds"]))
+	p = report["lateness_ms"]
+	if p["count"]:
+		print("lateness [ms]: p50 %.2f, p90 %.2f, p99 %.2f, max %.2f" % (p["p50"], p["p90"], p["p99"], p["max"]))
+	for name, count in sorted(report["answers"].items(), key=lambda item: str(item[0])):
+		print("%-24s %8d" % (name, count))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Replays captured Artemis traffic against a warserver.')
+	parser.add_argument('capture', type=str, help='capture file of start_warserver.py --capture')
+	parser.add_argument('--host', type=str, default='127.0.0.1', help='the warserver')
+	parser.add_argument('--port', type=int, default=3000)
+	parser.add_argument('--speed', type=float, default=1, metavar='FACTOR', help='2 replays twice as fast, 0 as fast as possible')
+	parser.add_argument('--same_address', action='store_true', help='send from 127.0.0.1 only')
+	parser.add_argument('--start_server', action='store_true', help='start a fresh warserver on loopback for the replay')
+	parser.add_argument('--server_startup', type=float, default=3, metavar='SECONDS')
+	parser.add_argument('--quiet_server', action='store_true', help='hide the output of the started warserver')
+	parser.add_argument('--json', action='store_true', help='print the report as json')
+	args = parser.parse_args()
+
+	records = [record for record in capture.read_capture(args.capture) if record[1] == capture.INBOUND]
+	if not records:
+		sys.exit(args.capture + " contains no inbound datagrams")
+	args.ships = len({record[2] for record in records})	#for start_server
+	server = start_server(args) if args.start_server else None
+	try:
+		report = asyncio.run(replay(args, records))
+	finally:
+		if server is not None:
+			server.terminate()
+			server.wait()
+	if args.json:
+		print(json.dumps(report, indent=2))
+	else:
+		print_report(report)